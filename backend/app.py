@@ -1,12 +1,33 @@
 # ----------------------------------------------------------------------------#
 # Imports
 # ----------------------------------------------------------------------------#
-from flask import Flask, jsonify, request, abort
-from models import setup_db, test_db, Region, Habitat, Bird
+import os
+import time
+import click
+from operator import attrgetter
+from sqlalchemy import select, Row
+from flask import (Flask, Response, jsonify, request, abort,
+                   stream_with_context)
+from models import (db, setup_db, init_db, default_database_path, Region,
+                    Habitat, BirdCard, refresh_bird_cards, refresh_counts,
+                    reference_rows)
 from flask_cors import CORS
 from werkzeug.exceptions import HTTPException
-from populate import populate_region, populate_habitats, populate_birds
-from auth import AuthError, requires_auth
+from seeding import seed_test_db
+from auth import AuthError, requires_auth, check_permissions, token_cache
+from search import search_names, SEARCH_KINDS
+from graph import region_birds_query, related_birds_query, habitat_stats_query
+from bulk import parse_rows, load_birds, load_habitats, BULK_BATCH_SIZE
+from export import stream_export, EXPORT_FORMATS
+from cache import (setup_cache, cached_response, conditional_response,
+                   invalidate_responses)
+from metrics import setup_metrics, METRICS_ENABLED
+from profiling import setup_profiling, timed, PROFILING_ENABLED
+from json_provider import ORJSONProvider
+from compress import compress_response
+from routing import (setup_routing, read_only, read_replica, record_write,
+                     LAST_WRITE_HEADER)
+import operations
 
 
 def werkzeug_exceptions(e):
@@ -16,58 +37,174 @@ def werkzeug_exceptions(e):
     abort(422)
 
 
+ERROR_MESSAGES = {
+    400: 'bad request',
+    403: 'forbidden',
+    404: 'resource not found',
+    405: 'method not allowed'}
+
+
+def operation_error(e):
+    '''operation_error(e) is the (code, message) of a failed batch operation'''
+    if not isinstance(e, HTTPException):
+        return 422, 'unprocessable'
+    if e.code in ERROR_MESSAGES:
+        return e.code, ERROR_MESSAGES[e.code]
+    # abort(422, message) carries the message the endpoint would return
+    if e.description != type(e).description:
+        return e.code, e.description
+    return e.code, 'unprocessable'
+
+
 # ----------------------------------------------------------------------------#
 # Filters.
 # ----------------------------------------------------------------------------#
 ITEMS_PER_PAGE = 10
+MAX_ITEMS_PER_PAGE = int(os.environ.get('MAX_ITEMS_PER_PAGE', 100))
+BATCH_MAX_OPERATIONS = int(os.environ.get('BATCH_MAX_OPERATIONS', 100))
+
+
+def page_limit(request):
+    '''page_limit(request) is the requested page size capped at MAX_ITEMS_PER_PAGE'''
+    items_limit = min(request.args.get('limit', ITEMS_PER_PAGE, type=int),
+                      MAX_ITEMS_PER_PAGE)
+    if items_limit < 1:
+        abort(400)
+    return items_limit
+
+
+@timed('paginate')
+def paginate_items(request, selection_query, cursor_column=None,
+                   format_item=lambda item: item.format()):
+    '''
+    paginate_items(request, selection_query, cursor_column, format_item)
+    returns a page of formatted items and the cursor of the next page (None
+    on the last page). ?after=<id> pages on cursor_column (keyset),
+    otherwise ?page is used.
+    '''
+    items_limit = page_limit(request)
+
+    if cursor_column is not None and 'after' in request.args:
+        after = request.args.get('after', None, type=int)
+        # a cursor that is not an id is a malformed request
+        if after is None:
+            abort(400)
+        selection_query = selection_query.filter(cursor_column > after)
+    else:
+        selected_page = request.args.get('page', 1, type=int)
+        current_index = selected_page - 1
+        selection_query = selection_query.offset(current_index * items_limit)
 
-
-def paginate_items(request, selection_query):
-    selected_page = request.args.get('page', 1, type=int)
-    items_limit = request.args.get('limit', ITEMS_PER_PAGE, type=int)
-    current_index = selected_page - 1
-    selection = selection_query.limit(items_limit).offset(
-        current_index * items_limit).all()
+    # one extra row tells whether there is a next page
+    selection = selection_query.limit(items_limit + 1).all()
     # If the page query param is out of range abort
     if len(selection) == 0:
         abort(404)
-    items = [item.format() for item in selection]
-    return items
+
+    next_cursor = None
+    if len(selection) > items_limit:
+        selection = selection[:items_limit]
+        if cursor_column is not None:
+            next_cursor = getattr(selection[-1], cursor_column.key)
+
+    items = [format_item(item) for item in selection]
+    return items, next_cursor
+
+
+def count_items(request, selection_query):
+    '''count_items returns SELECT COUNT(*) of the query or None if total=false'''
+    if request.args.get('total', 'true').lower() in ('false', '0'):
+        return None
+    return selection_query.order_by(None).count()
+
+
+def bulk_load(request, loader):
+    '''bulk_load(request, loader) loads the NDJSON/CSV/JSON request body'''
+    try:
+        rows = parse_rows(request.get_data(as_text=True),
+                          request.content_type or '')
+    except ValueError:
+        # a JSON list that cannot be parsed is a bad request
+        abort(400)
+    # nothing to load is a bad request
+    if len(rows) == 0:
+        abort(400)
+    batch_size = request.args.get('batch_size', BULK_BATCH_SIZE, type=int)
+    if batch_size < 1:
+        abort(400)
+    report = loader(rows, batch_size=batch_size)
+    return {
+        'success': True,
+        'total_rows': len(rows),
+        'inserted': report['inserted'],
+        'errors': report['errors']}
+
+
+def export_response(request, kind):
+    '''export_response(request, kind) streams the birds or habitats'''
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    response = Response(
+        stream_with_context(stream_export(kind, export_format)),
+        mimetype=EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = (
+        f'attachment; filename={kind}.{export_format}')
+    return response
 
 # ----------------------------------------------------------------------------#
 # App Config.
 # ----------------------------------------------------------------------------#
 
 
+def startup_report(checkpoints):
+    '''
+    startup_report(checkpoints) turns the (phase, perf_counter) pairs of
+    create_app into the milliseconds of each phase and the total
+    '''
+    report = {}
+    for (_, previous), (phase, now) in zip(checkpoints, checkpoints[1:]):
+        report[phase] = round((now - previous) * 1000, 2)
+    report['total'] = round((checkpoints[-1][1] - checkpoints[0][1]) * 1000, 2)
+    return report
+
+
 def create_app(test_config=None):
 
+    checkpoints = [('start', time.perf_counter())]
     app = Flask(__name__)
+    app.json = ORJSONProvider(app)
+    pool_metrics = setup_metrics(app, test_config if test_config is not None
+                                 else default_database_path())
     if test_config is not None:
         setup_db(app, test_config)
-        test_db(app)
-        with app.app_context():
-            populate_region()
-            populate_habitats()
-            populate_birds()
+        # populated once, then restored from a snapshot
+        seed_test_db(app)
     else:
+        # the schema is created by "flask init-db", not on every boot
         setup_db(app)
-        # with app.app_context():
-        #     populate_region()
-        #     populate_habitats()
-        #     populate_birds()
-        
-
-    CORS(app, origins='*')
+    checkpoints.append(('database', time.perf_counter()))
+
+    setup_cache(app)
+    setup_routing(app)
+    with app.app_context():
+        pool_metrics.listen(db.engine)
+        if PROFILING_ENABLED:
+            setup_profiling(app, db.engines.values())
+    # the browser lets the frontend read and send back the last write
+    CORS(app, origins='*', expose_headers=[LAST_WRITE_HEADER])
+    checkpoints.append(('extensions', time.perf_counter()))
 
     @app.after_request
     def after_request(response):
         response.headers.add(
-            'Access-Control-Allow-Headers', 'Content-Type,Authorization,true'
+            'Access-Control-Allow-Headers',
+            f'Content-Type,Authorization,{LAST_WRITE_HEADER},true'
         )
         response.headers.add(
             'Access-Control-Allow-Methods', 'GET,PATCH,POST,DELETE,OPTIONS'
         )
-        return response
+        return compress_response(record_write(response))
 
     # ----------------------------------------------------------------------------#
     # Birds.
@@ -75,25 +212,37 @@ def create_app(test_config=None):
 
     @app.route('/birds', methods=['GET'])
     @requires_auth('get:birds')
+    @read_only
+    @conditional_response('Birds', 'Habitats', 'Regions')
+    @cached_response
     def get_birds(payload):
         try:
-            selection_query = Bird.query.order_by(Bird.id)
-            current_birds = paginate_items(request, selection_query)
-            return jsonify(
-                {
-                    'success': True,
-                    'birds': current_birds,
-                    'total_birds': len(selection_query.all())
-                }
-            )
+            selection_query = db.session.query(
+                BirdCard.bird_id, BirdCard.card).order_by(BirdCard.bird_id)
+            current_birds, next_cursor = paginate_items(
+                request, selection_query, BirdCard.bird_id,
+                attrgetter('card'))
+            response = {
+                'success': True,
+                'birds': current_birds,
+                'next_cursor': next_cursor
+            }
+            total_birds = count_items(request, selection_query)
+            if total_birds is not None:
+                response['total_birds'] = total_birds
+            return jsonify(response)
         except Exception as e:
             werkzeug_exceptions(e)
 
     @app.route('/birds/<int:bird_id>', methods=['GET'])
     @requires_auth('get:birds')
+    @read_only
+    @conditional_response('Birds', 'Habitats', 'Regions')
+    @cached_response
     def get_specified_bird(payload, bird_id):
         try:
-            bird = Bird.query.filter(Bird.id == bird_id).one_or_none()
+            bird = db.session.scalar(
+                select(BirdCard.card).where(BirdCard.bird_id == bird_id))
 
             # Resource not found
             if bird is None:
@@ -102,40 +251,51 @@ def create_app(test_config=None):
             return jsonify(
                 {
                     'success': True,
-                    'bird': bird.format()
+                    'bird': bird
                 }
             )
         except Exception as e:
             werkzeug_exceptions(e)
 
-    @app.route('/birds', methods=['POST'])
-    @requires_auth('post:birds')
-    def add_bird(payload):
+    @app.route('/birds/<int:bird_id>/related', methods=['GET'])
+    @requires_auth('get:birds')
+    @read_only
+    @conditional_response('Birds', 'Habitats', 'Regions')
+    @cached_response
+    def get_related_birds(payload, bird_id):
         try:
-            body = request.get_json()
-            common_name = body.get('common_name', None)
-            species = body.get('species', None)
-            habitats = body.get('habitats', None)
-            image_link = body.get('image_link', '')
-
-            # if required attributes are not submitted abort
-            if None in [common_name, species, habitats] or len(habitats) == 0:
+            min_shared = request.args.get('min_shared', 1, type=int)
+            if min_shared < 1:
                 abort(400)
-
-            get_habitats = Habitat.query.filter(
-                Habitat.id.in_(habitats)).all()
-
-            # one of the habitats provided doesnt match the habitats in the db abort
-            if (len(get_habitats) is not len(habitats)):
+            # Resource not found
+            if db.session.scalar(select(BirdCard.bird_id).where(
+                    BirdCard.bird_id == bird_id)) is None:
                 abort(404)
 
-            new_bird = Bird(common_name, species, image_link)
-            new_bird.habitats = get_habitats
+            selection_query = related_birds_query(bird_id, min_shared)
+            related_birds, _ = paginate_items(
+                request, selection_query,
+                format_item=lambda row: {
+                    **row.card, 'shared_habitats': row.shared_habitats})
+            response = {
+                'success': True,
+                'bird': bird_id,
+                'related_birds': related_birds
+            }
+            total_birds = count_items(request, selection_query)
+            if total_birds is not None:
+                response['total_birds'] = total_birds
+            return jsonify(response)
+        except Exception as e:
+            werkzeug_exceptions(e)
 
-            try:
-                new_bird.insert()
-            except:
-                abort(422, 'duplicate bird resource')
+    @app.route('/birds', methods=['POST'])
+    @requires_auth('post:birds')
+    def add_bird(payload):
+        try:
+            new_bird, cached_paths = operations.create_bird(request.get_json())
+            db.session.commit()
+            invalidate_responses(*cached_paths)
 
             return jsonify(
                 {
@@ -146,43 +306,31 @@ def create_app(test_config=None):
         except Exception as e:
             werkzeug_exceptions(e)
 
+    @app.route('/birds/bulk', methods=['POST'])
+    @requires_auth('post:birds')
+    def bulk_add_birds(payload):
+        try:
+            report = bulk_load(request, load_birds)
+            if report['inserted']:
+                invalidate_responses('/birds')
+            return jsonify(report)
+        except Exception as e:
+            werkzeug_exceptions(e)
+
     @app.route('/birds/<int:bird_id>', methods=['PATCH'])
     @requires_auth('patch:birds')
     def edit_bird(payload, bird_id):
         try:
-            edit_bird = Bird.query.filter(Bird.id == bird_id).one_or_none()
-            # Resource not found
-            if edit_bird is None:
-                abort(404)
-
-            body = request.get_json()
-            habitats = body.get('habitats', None)
-
-            if habitats is not None:
-                get_habitats = Habitat.query.filter(
-                    Habitat.id.in_(habitats)).all()
-                # one of the habitats provided doesnt match the habitats in the db abort
-                if (len(get_habitats) is not len(habitats)):
-                    abort(404)
-                edit_bird.habitats = get_habitats
-                try:
-                    edit_bird.update()
-                except:
-                    abort(422)
-
-            for att in ['common_name', 'species', 'image_link']:
-                attribute = body.get(att, None)
-                if attribute:
-                    setattr(edit_bird, att, attribute)
-                    try:
-                        edit_bird.update()
-                    except:
-                        abort(422, f'Bird {att} already exist')
+            edit_bird, cached_paths = operations.patch_bird(
+                bird_id, request.get_json())
+            db.session.commit()
+            invalidate_responses(*cached_paths)
 
             return jsonify(
                 {
                     'success': True,
                     'bird': edit_bird.id,
+                    'updated': edit_bird.format(),
                 }
             )
         except Exception as e:
@@ -192,14 +340,9 @@ def create_app(test_config=None):
     @requires_auth('delete:birds')
     def delete_bird(payload, bird_id):
         try:
-            bird = Bird.query.filter(
-                Bird.id == bird_id).one_or_none()
-
-            # If bird cannot be found abort
-            if bird is None:
-                abort(404)
-
-            bird.delete()
+            _, cached_paths = operations.delete_bird(bird_id)
+            db.session.commit()
+            invalidate_responses(*cached_paths)
 
             return jsonify(
                 {
@@ -217,26 +360,58 @@ def create_app(test_config=None):
 
     @app.route('/habitats', methods=['GET'])
     @requires_auth('get:habitats')
+    @read_only
+    @conditional_response('Birds', 'Habitats')
+    @cached_response
     def get_habitats(payload):
         try:
-            habitats_query = Habitat.query.order_by(Habitat.id)
-            current_habitats = paginate_items(request, habitats_query)
-            return jsonify(
-                {
-                    'success': True,
-                    'habitats': current_habitats,
-                    'total_habitats': len(habitats_query.all())
-                }
-            )
+            # rows of the Habitat.format() columns, no Habitat objects
+            habitats_query = db.session.query(
+                Habitat.id, Habitat.name, Habitat.region_id,
+                Habitat.bird_count).order_by(Habitat.id)
+            current_habitats, next_cursor = paginate_items(
+                request, habitats_query, Habitat.id, Row._asdict)
+            response = {
+                'success': True,
+                'habitats': current_habitats,
+                'next_cursor': next_cursor
+            }
+            total_habitats = count_items(request, habitats_query)
+            if total_habitats is not None:
+                response['total_habitats'] = total_habitats
+            return jsonify(response)
+        except Exception as e:
+            werkzeug_exceptions(e)
+
+    @app.route('/habitats/stats', methods=['GET'])
+    @requires_auth('get:habitats')
+    @read_only
+    @conditional_response('Birds', 'Habitats')
+    @cached_response
+    def get_habitat_stats(payload):
+        try:
+            selection_query = habitat_stats_query()
+            habitats, _ = paginate_items(
+                request, selection_query, format_item=Row._asdict)
+            response = {
+                'success': True,
+                'habitats': habitats
+            }
+            total_habitats = count_items(request, selection_query)
+            if total_habitats is not None:
+                response['total_habitats'] = total_habitats
+            return jsonify(response)
         except Exception as e:
             werkzeug_exceptions(e)
 
     @app.route('/habitats/<int:habitat_id>', methods=['GET'])
     @requires_auth('get:habitats')
+    @read_only
+    @conditional_response('Birds', 'Habitats')
+    @cached_response
     def get_specified_habitat(payload, habitat_id):
         try:
-            habitat = Habitat.query.filter(
-                Habitat.id == habitat_id).one_or_none()
+            habitat = reference_rows('Habitats').get(habitat_id)
             # Resource not found
             if habitat is None:
                 abort(404)
@@ -244,7 +419,7 @@ def create_app(test_config=None):
             return jsonify(
                 {
                     'success': True,
-                    'habitat': habitat.format()
+                    'habitat': habitat._asdict()
                 }
             )
         except Exception as e:
@@ -255,51 +430,31 @@ def create_app(test_config=None):
     def add_or_search_habitats(payload):
         try:
             body = request.get_json()
-            name = body.get('name', None)
-            region_id = body.get('region_id', None)
-            habitat_bird = body.get('bird', None)
             search = body.get('search', None)
 
             if search:
-                habitats = Habitat.query.filter(
-                    Habitat.name.ilike('%' + search + '%')).all()
-                formatted_habitats = [item.format() for item in habitats]
+                with read_replica(payload):
+                    results, total_habitats = search_names(
+                        search, ['habitats'])
+                    habitats_by_id = reference_rows('Habitats')
+                # keep the ranking of the search, skipping a habitat the
+                # cached rows do not have (written since they were read)
+                formatted_habitats = [habitats_by_id[result['id']]._asdict()
+                                      for result in results
+                                      if result['id'] in habitats_by_id]
 
                 return jsonify(
                     {
                         'success': True,
                         'habitats': formatted_habitats,
-                        'total_habitats': len(habitats)
+                        'total_habitats': total_habitats
                     }
                 )
 
             else:
-
-                # if required attributes are not submitted abort
-                if None in [name, region_id]:
-                    abort(400)
-
-                region = Region.query.filter(
-                    Region.id == region_id).one_or_none()
-                # if invalid region is given abort
-                if region is None:
-                    abort(400)
-
-                new_habitat = Habitat(name=name, region_id=region.id)
-
-                if habitat_bird:
-                    update_bird = Bird.query.filter(
-                        Bird.id == habitat_bird).one_or_none()
-
-                    if update_bird is None:
-                        abort(400)
-
-                    new_habitat.Birds.append(update_bird)
-
-                try:
-                    new_habitat.insert()
-                except:
-                    abort(422, 'Habitat resource already exist')
+                new_habitat, cached_paths = operations.create_habitat(body)
+                db.session.commit()
+                invalidate_responses(*cached_paths)
 
                 return jsonify(
                     {
@@ -310,44 +465,31 @@ def create_app(test_config=None):
         except Exception as e:
             werkzeug_exceptions(e)
 
+    @app.route('/habitats/bulk', methods=['POST'])
+    @requires_auth('post:habitats')
+    def bulk_add_habitats(payload):
+        try:
+            report = bulk_load(request, load_habitats)
+            if report['inserted']:
+                invalidate_responses('/habitats')
+            return jsonify(report)
+        except Exception as e:
+            werkzeug_exceptions(e)
+
     @app.route('/habitats/<int:habitat_id>', methods=['PATCH'])
     @requires_auth('patch:habitats')
     def edit_habitats(payload, habitat_id):
         try:
-            edit_habitat = Habitat.query.filter(
-                Habitat.id == habitat_id).one_or_none()
-
-            # Resource not found
-            if edit_habitat is None:
-                abort(404)
-
-            body = request.get_json()
-            name = body.get('name', None)
-            region_id = body.get('region_id', None)
-
-            if name:
-                edit_habitat.name = name
-                try:
-                    edit_habitat.update()
-                except:
-                    abort(422, 'Habitat name already exist')
-
-            if region_id:
-                region = Region.query.filter(
-                    Region.id == region_id).one_or_none()
-                # if invalid region is given abort
-                if region is None:
-                    abort(400)
-                edit_habitat.region_id = region_id
-                try:
-                    edit_habitat.update()
-                except:
-                    abort(422)
+            edit_habitat, cached_paths = operations.patch_habitat(
+                habitat_id, request.get_json())
+            db.session.commit()
+            invalidate_responses(*cached_paths)
 
             return jsonify(
                 {
                     'success': True,
                     'habitat': edit_habitat.id,
+                    'updated': edit_habitat.format(),
                 }
             )
         except Exception as e:
@@ -357,14 +499,9 @@ def create_app(test_config=None):
     @requires_auth('delete:habitats')
     def delete_habitat(payload, habitat_id):
         try:
-            habitat = Habitat.query.filter(
-                Habitat.id == habitat_id).one_or_none()
-
-            # If bird cannot be found abort
-            if habitat is None:
-                abort(404)
-
-            habitat.delete()
+            _, cached_paths = operations.delete_habitat(habitat_id)
+            db.session.commit()
+            invalidate_responses(*cached_paths)
 
             return jsonify(
                 {
@@ -381,10 +518,17 @@ def create_app(test_config=None):
     # ----------------------------------------------------------------------------#
     @app.route('/regions', methods=['GET'])
     @requires_auth('get:regions')
+    @read_only
+    @conditional_response('Birds', 'Habitats', 'Regions')
+    @cached_response
     def get_regions(payload):
         try:
-            regions = Region.query.order_by(Region.id).all()
-            regions_formatted = [region.format() for region in regions]
+            # the counters change with every bird, so not the reference rows
+            regions = db.session.execute(
+                select(Region.id, Region.name, Region.image_link,
+                       Region.habitat_count, Region.bird_count)
+                .order_by(Region.id)).all()
+            regions_formatted = [region._asdict() for region in regions]
             return jsonify(
                 {
                     'success': True,
@@ -394,6 +538,211 @@ def create_app(test_config=None):
         except Exception as e:
             werkzeug_exceptions(e)
 
+    @app.route('/regions/<int:region_id>/birds', methods=['GET'])
+    @requires_auth('get:birds')
+    @read_only
+    @conditional_response('Birds', 'Habitats', 'Regions')
+    @cached_response
+    def get_region_birds(payload, region_id):
+        try:
+            # Resource not found
+            if region_id not in reference_rows('Regions'):
+                abort(404)
+
+            selection_query = region_birds_query(region_id)
+            current_birds, next_cursor = paginate_items(
+                request, selection_query, BirdCard.bird_id,
+                attrgetter('card'))
+            response = {
+                'success': True,
+                'region': region_id,
+                'birds': current_birds,
+                'next_cursor': next_cursor
+            }
+            total_birds = count_items(request, selection_query)
+            if total_birds is not None:
+                response['total_birds'] = total_birds
+            return jsonify(response)
+        except Exception as e:
+            werkzeug_exceptions(e)
+
+    # ----------------------------------------------------------------------------#
+    # Search.
+    # ----------------------------------------------------------------------------#
+    @app.route('/search', methods=['GET'])
+    @requires_auth('get:birds')
+    @read_only
+    @conditional_response('Birds', 'Habitats')
+    @cached_response
+    def search_catalogue(payload):
+        try:
+            term = request.args.get('q', '').strip()
+            kind = request.args.get('type', None)
+            # a search term is required and type must be birds or habitats
+            if not term or kind not in (None,) + SEARCH_KINDS:
+                abort(400)
+
+            items_limit = page_limit(request)
+            selected_page = request.args.get('page', 1, type=int)
+            if selected_page < 1:
+                abort(400)
+
+            results, total_results = search_names(
+                term, [kind] if kind else SEARCH_KINDS,
+                items_limit, (selected_page - 1) * items_limit)
+            return jsonify(
+                {
+                    'success': True,
+                    'results': results,
+                    'total_results': total_results
+                }
+            )
+        except Exception as e:
+            werkzeug_exceptions(e)
+
+    # ----------------------------------------------------------------------------#
+    # Export.
+    # ----------------------------------------------------------------------------#
+    @app.route('/export/birds', methods=['GET'])
+    @requires_auth('get:birds')
+    def export_birds(payload):
+        try:
+            return export_response(request, 'birds')
+        except Exception as e:
+            werkzeug_exceptions(e)
+
+    @app.route('/export/habitats', methods=['GET'])
+    @requires_auth('get:habitats')
+    def export_habitats(payload):
+        try:
+            return export_response(request, 'habitats')
+        except Exception as e:
+            werkzeug_exceptions(e)
+
+    # ----------------------------------------------------------------------------#
+    # Batch.
+    # ----------------------------------------------------------------------------#
+    @app.route('/batch', methods=['POST'])
+    @requires_auth(None)
+    def batch(payload):
+        try:
+            body = request.get_json()
+            batch_operations = body.get('operations', None)
+            atomic = body.get('atomic', True)
+
+            # an empty, oversized or malformed batch is a bad request
+            if (not isinstance(batch_operations, list) or
+                    not 0 < len(batch_operations) <= BATCH_MAX_OPERATIONS):
+                abort(400)
+            for permission in operations.validate_batch(batch_operations):
+                check_permissions(permission, payload)
+
+            results, cached_paths = [], set()
+            for index, operation in enumerate(batch_operations):
+                try:
+                    # every operation runs in a savepoint of one transaction
+                    with db.session.begin_nested():
+                        resource, paths = operations.run_operation(operation)
+                        resource_id = resource.id
+                except Exception as e:
+                    code, message = operation_error(e)
+                    results.append({
+                        'index': index,
+                        'success': False,
+                        'error': code,
+                        'message': message})
+                    continue
+                cached_paths.update(paths)
+                results.append({
+                    'index': index,
+                    'success': True,
+                    'id': resource_id})
+
+            failed = any(not result['success'] for result in results)
+            if atomic and failed:
+                db.session.rollback()
+                return jsonify({
+                    'success': False,
+                    'error': 422,
+                    'message': 'batch rolled back',
+                    'results': results
+                }), 422
+
+            db.session.commit()
+            invalidate_responses(*cached_paths)
+
+            return jsonify(
+                {
+                    'success': True,
+                    'results': results
+                }
+            )
+        except Exception as e:
+            werkzeug_exceptions(e)
+
+    # ----------------------------------------------------------------------------#
+    # Metrics.
+    # ----------------------------------------------------------------------------#
+    if METRICS_ENABLED:
+        @app.route('/metrics', methods=['GET'])
+        @requires_auth('get:metrics')
+        def metrics(payload):
+            return jsonify(
+                {
+                    'success': True,
+                    'database_pool': app.extensions['pool_metrics'].stats(),
+                    'token_cache': token_cache.stats(),
+                    'startup_ms': app.extensions['startup_ms'],
+                    'routes': app.extensions['route_histograms'].stats()
+                    if 'route_histograms' in app.extensions else None
+                }
+            )
+
+    # ----------------------------------------------------------------------------#
+    # Commands.
+    # ----------------------------------------------------------------------------#
+    @app.cli.command('bulk-import')
+    @click.argument('kind', type=click.Choice(['birds', 'habitats']))
+    @click.argument('file', type=click.File(encoding='utf-8'))
+    @click.option('--batch-size', default=BULK_BATCH_SIZE, show_default=True)
+    def bulk_import(kind, file, batch_size):
+        '''Import birds or habitats from a NDJSON or CSV (.csv) file.'''
+        content_type = 'text/csv' if file.name.endswith(
+            '.csv') else 'application/x-ndjson'
+        rows = parse_rows(file.read(), content_type)
+        loader = load_birds if kind == 'birds' else load_habitats
+        report = loader(rows, batch_size=batch_size)
+        for error in report['errors']:
+            click.echo(f'row {error["row"]}: {error["error"]}', err=True)
+        click.echo(f'inserted {report["inserted"]} of {len(rows)} {kind}')
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        '''Create the missing tables and columns, the bird cards and counts.'''
+        init_db()
+        click.echo('database initialized')
+
+    @app.cli.command('startup-report')
+    def startup_report_command():
+        '''Print how long each phase of create_app took.'''
+        for phase, milliseconds in app.extensions['startup_ms'].items():
+            click.echo(f'{phase:<12} {milliseconds:>10.2f} ms')
+
+    @app.cli.command('rebuild-bird-cards')
+    def rebuild_bird_cards():
+        '''Rebuild the bird cards served by /birds from the birds.'''
+        refresh_bird_cards(db.session.connection())
+        db.session.commit()
+        click.echo(f'rebuilt {db.session.query(BirdCard).count()} bird cards')
+
+    @app.cli.command('rebuild-counts')
+    def rebuild_counts():
+        '''Recount the birds and habitats of every habitat and region.'''
+        refresh_counts(db.session.connection())
+        db.session.commit()
+        click.echo(f'recounted {db.session.query(Habitat).count()} habitats '
+                   f'and {db.session.query(Region).count()} regions')
+
     # ----------------------------------------------------------------------------#
     # Error Handlers.
     # ----------------------------------------------------------------------------#
@@ -454,10 +803,23 @@ def create_app(test_config=None):
             'message': error.error.get('description', 'AuthError')
         }), error.status_code
 
+    checkpoints.append(('routes', time.perf_counter()))
+    app.extensions['startup_ms'] = startup_report(checkpoints)
+    app.logger.info('app created in %s ms', app.extensions['startup_ms'])
     return app
 
 
-app = create_app()
+def __getattr__(name):
+    '''
+    The module level app ("flask run", "gunicorn app:app") is created on
+    first access, so importing create_app does not connect to DATABASE_URL
+    '''
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
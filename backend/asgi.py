@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import os
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+from app import create_app
+from auth import jwks_cache
+
+
+'''
+ASGI entry point, run with "uvicorn asgi:application".
+
+The event loop reads the request bodies, so a slow upload costs a socket
+instead of a thread, and the Auth0 keys are fetched in the background so
+no request waits on the JWKS download. The Flask app (same routes, error
+handlers and requires_auth) is still synchronous: asgiref's WsgiToAsgi
+runs each request in a thread of its own, up to ASGI_THREADS at once, and
+its handlers and database queries block that thread until the response is
+sent. Expect the throughput of the WSGI server, not of an async one.
+'''
+
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+
+logger = logging.getLogger(__name__)
+
+
+class ASGIApplication:
+    '''
+    ASGIApplication
+    Serves a flask application over ASGI and refreshes the JWKS cache on
+    the event loop for the lifetime of the server.
+    '''
+
+    def __init__(self, flask_app, threads=ASGI_THREADS, jwks=jwks_cache):
+        self.flask_app = flask_app
+        self.wsgi_app = WsgiToAsgi(flask_app)
+        self.threads = threads
+        self.jwks = jwks
+        self.slots = asyncio.Semaphore(threads)
+        self._refresher = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        else:
+            async with self.slots:
+                # WsgiToAsgi runs the app thread sensitive, in a thread of
+                # the context instead of one thread shared by all requests
+                async with ThreadSensitiveContext():
+                    await self.wsgi_app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        await self.refresh_jwks()
+        self._refresher = asyncio.create_task(self.refresh_jwks_forever())
+
+    async def shutdown(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+
+    async def refresh_jwks(self):
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.jwks.refresh)
+        except Exception:
+            # requests fall back to fetching the keys themselves
+            logger.exception('could not fetch the JWKS')
+
+    async def refresh_jwks_forever(self):
+        # refresh halfway through the ttl so the keys never go stale
+        while True:
+            await asyncio.sleep(max(self.jwks.ttl / 2, 1))
+            await self.refresh_jwks()
+
+
+def create_asgi_app(test_config=None):
+    '''create_asgi_app(test_config) is create_app served over ASGI'''
+    return ASGIApplication(create_app(test_config))
+
+
+def __getattr__(name):
+    '''"uvicorn asgi:application" creates the app on first access'''
+    if name == 'application':
+        global application
+        from app import app as flask_app
+        application = ASGIApplication(flask_app)
+        return application
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
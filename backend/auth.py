@@ -1,15 +1,27 @@
+import hashlib
 import json
 import os
-from flask import request, abort
+import threading
+import time
+from collections import OrderedDict
+from flask import request, abort, g
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
+from profiling import timed, timer
 
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = [os.environ['ALGORITHMS']]
 API_AUDIENCE = os.environ['API_AUDIENCE']
 
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_MAX_STALE = int(os.environ.get('JWKS_MAX_STALE', 86400))
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
 
 class AuthError(Exception):
     '''
@@ -65,12 +77,177 @@ def check_permissions(permission, payload):
         abort(403)
     return True
 
+
+@timed('jwks')
 def get_jwks():
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json',
+                      timeout=JWKS_FETCH_TIMEOUT)
     return json.loads(jsonurl.read())
 
+
+class JWKSCache:
+    '''
+    JWKSCache
+    Keeps the Auth0 signing keys in memory so requests do not fetch the
+    JWKS. Keys are fresh for ttl seconds, only one thread refreshes at a
+    time, an unknown kid forces a refresh (at most once per
+    min_refresh_interval) and while a refresh is running or failing the
+    previous keys are served for up to max_stale seconds.
+    '''
+
+    def __init__(self, fetch=None, ttl=JWKS_CACHE_TTL,
+                 max_stale=JWKS_MAX_STALE,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.min_refresh_interval = min_refresh_interval
+        self._keys = {}
+        self._fetched_at = None
+        self._attempted_at = None
+        self._lock = threading.Lock()
+
+    def _age(self):
+        if self._fetched_at is None:
+            return None
+        return time.monotonic() - self._fetched_at
+
+    def _is_fresh(self):
+        age = self._age()
+        return age is not None and age < self.ttl
+
+    def _is_usable(self):
+        age = self._age()
+        return age is not None and age < self.ttl + self.max_stale
+
+    def _recently_attempted(self):
+        return (self._attempted_at is not None and
+                time.monotonic() - self._attempted_at
+                < self.min_refresh_interval)
+
+    def _refresh(self):
+        self._attempted_at = time.monotonic()
+        # get_jwks is looked up on every call so tests can patch auth.get_jwks
+        fetch = self.fetch or get_jwks
+        jwks = fetch()
+        self._keys = {key['kid']: key for key in jwks.get('keys', [])
+                      if 'kid' in key}
+        self._fetched_at = self._attempted_at
+
+    def refresh(self):
+        '''refresh() fetches the keys ahead of the requests that need them'''
+        with self._lock:
+            self._refresh()
+
+    def get_key(self, kid):
+        '''get_key(kid) returns the JWK for kid or None if it is unknown'''
+        if kid in self._keys and self._is_fresh():
+            return self._keys[kid]
+
+        if kid in self._keys and self._is_usable():
+            # stale-while-revalidate: one caller refreshes, the others
+            # keep serving the stale keys instead of queueing up
+            if (not self._recently_attempted() and
+                    self._lock.acquire(blocking=False)):
+                try:
+                    self._refresh()
+                except Exception:
+                    pass
+                finally:
+                    self._lock.release()
+            return self._keys.get(kid)
+
+        # unknown kid or nothing usable cached: wait for a refresh
+        fetched_at = self._fetched_at
+        with self._lock:
+            refreshed = self._fetched_at != fetched_at
+            throttled = self._is_usable() and self._recently_attempted()
+            if not refreshed and not throttled:
+                try:
+                    self._refresh()
+                except Exception:
+                    if not self._is_usable():
+                        raise
+        if not self._is_usable():
+            return None
+        return self._keys.get(kid)
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._attempted_at = None
+
+
+class TokenCache:
+    '''
+    TokenCache
+    Bounded LRU of verified token payloads keyed by the sha256 of the raw
+    token, so a bearer token that is sent again skips the RSA signature
+    check. Entries expire at the exp claim of the token.
+    '''
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return dict(entry[0])
+
+    def set(self, token, payload):
+        expires_at = payload.get('exp')
+        # tokens without a numeric exp claim are never cached
+        if self.maxsize <= 0 or not isinstance(expires_at, (int, float)):
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (dict(payload), expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+jwks_cache = JWKSCache()
+token_cache = TokenCache()
+
+
+@timed('jwt')
 def verify_decode_jwt(token):
-    jwks = get_jwks()
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     try:
         unverified_header = jwt.get_unverified_header(token)
         rsa_key = {}
@@ -80,15 +257,15 @@ def verify_decode_jwt(token):
                 'description': 'authorization malformed'
             }, 401)
 
-        for key in jwks['keys']:
-            if key['kid'] == unverified_header['kid']:
-                rsa_key = {
-                    'kty': key['kty'],
-                    'kid': key['kid'],
-                    'use': key['use'],
-                    'n': key['n'],
-                    'e': key['e']
-                }
+        key = jwks_cache.get_key(unverified_header['kid'])
+        if key:
+            rsa_key = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
 
         if rsa_key:
             try:
@@ -99,6 +276,7 @@ def verify_decode_jwt(token):
                     audience=API_AUDIENCE,
                     issuer='https://' + AUTH0_DOMAIN + '/',
                 )
+                token_cache.set(token, payload)
                 return payload
 
             except jwt.ExpiredSignatureError:
@@ -129,12 +307,16 @@ def verify_decode_jwt(token):
 
 
 def requires_auth(permission=''):
+    '''requires_auth(None) only verifies the token, the handler checks permissions'''
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with timer('auth'):
+                token = get_token_auth_header()
+                payload = verify_decode_jwt(token)
+                g.auth_payload = payload
+                if permission is not None:
+                    check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
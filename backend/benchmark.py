@@ -0,0 +1,338 @@
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+
+'''
+Load test of the API on the WSGI app (werkzeug's threaded server, as
+"flask run") and the ASGI entry point (uvicorn asgi:application), plus
+micro-benchmarks of the hot path.
+
+    python benchmark.py --requests 2000 --concurrency 50 --slow-clients 200
+    python benchmark.py --birds 100000 --servers asgi --json results.json
+
+Tokens are signed with the keys of mock_rsa_keys and the JWKS is patched
+like in test_rbac.py, so no Auth0 account is needed. The app is created
+with create_app(BENCHMARK_DATABASE_URL) which drops and seeds that
+database, so never point it at real data. --birds adds copies of the
+populate.py birds through the bulk loader until the table holds that many.
+With --json the results are written as JSON (with the commit) so runs can
+be compared; set RESPONSE_CACHE_SIZE=0 to measure the uncached endpoints.
+'''
+
+ENDPOINTS = ['/birds', '/birds?limit=100', '/birds/1', '/habitats',
+             '/regions', '/search?q=eagle']
+SEED_CHUNK_SIZE = 50000
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+# ----------------------------------------------------------------------------#
+# Seeding
+# ----------------------------------------------------------------------------#
+
+
+def seed_birds(total):
+    '''
+    seed_birds(total) inserts numbered copies of the populate.py birds until
+    there are total birds, in chunks so a million rows never sit in memory
+    '''
+    from bulk import load_birds
+    from models import db, Bird
+    from populate import BIRDS
+
+    existing = Bird.query.count()
+    number = 0
+    while existing < total:
+        count = min(SEED_CHUNK_SIZE, total - existing)
+        rows = []
+        for _ in range(count):
+            template = BIRDS[number % len(BIRDS)]
+            number += 1
+            rows.append((number, {
+                **template,
+                'common_name': f'{template["common_name"]} {number}'}))
+        report = load_birds(rows, batch_size=5000)
+        if report['errors']:
+            raise ValueError(report['errors'][:5])
+        existing += report['inserted']
+    db.session.remove()
+    return existing
+
+
+# ----------------------------------------------------------------------------#
+# Servers
+# ----------------------------------------------------------------------------#
+
+
+def start_wsgi(flask_app, port):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', port, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown
+
+
+def start_asgi(flask_app, port, threads):
+    import uvicorn
+    from asgi import ASGIApplication
+    server = uvicorn.Server(uvicorn.Config(
+        ASGIApplication(flask_app, threads=threads), host='127.0.0.1',
+        port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return stop
+
+
+# ----------------------------------------------------------------------------#
+# Clients
+# ----------------------------------------------------------------------------#
+
+
+def hold_slow_clients(port, count):
+    '''opens count connections that send half a request and then wait'''
+    sockets = []
+    for _ in range(count):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(b'GET /regions HTTP/1.1\r\nHost: localhost\r\n')
+        sockets.append(sock)
+    return sockets
+
+
+def run_clients(port, headers, requests, concurrency):
+    '''
+    requests spread over the ENDPOINTS by concurrency keep-alive clients,
+    returns the elapsed time, the latencies of each endpoint and the errors
+    '''
+    latencies, errors = {path: [] for path in ENDPOINTS}, []
+    lock = threading.Lock()
+
+    def client(count, offset):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        for number in range(count):
+            path = ENDPOINTS[(offset + number) % len(ENDPOINTS)]
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection(
+                    '127.0.0.1', port, timeout=30)
+                ok = False
+            with lock:
+                if ok:
+                    latencies[path].append(time.perf_counter() - start)
+                else:
+                    errors.append(path)
+        connection.close()
+
+    shares = [requests // concurrency + (number < requests % concurrency)
+              for number in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for number, count in enumerate(shares):
+            pool.submit(client, count, number)
+    return time.perf_counter() - start, latencies, errors
+
+
+# ----------------------------------------------------------------------------#
+# Results
+# ----------------------------------------------------------------------------#
+
+
+def percentile(ordered, fraction):
+    '''percentile(ordered, fraction) is the nearest rank percentile'''
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summary(timings):
+    '''summary(timings) are the count, mean, p50, p99 and max in ms'''
+    if not timings:
+        return {'count': 0}
+    ordered = sorted(timings)
+    return {'count': len(ordered),
+            'mean_ms': round(sum(ordered) / len(ordered) * 1000, 4),
+            'p50_ms': round(percentile(ordered, 0.5) * 1000, 4),
+            'p99_ms': round(percentile(ordered, 0.99) * 1000, 4),
+            'max_ms': round(ordered[-1] * 1000, 4)}
+
+
+def server_results(elapsed, latencies, errors):
+    every = [latency for timings in latencies.values() for latency in timings]
+    return {'requests_per_second': round(len(every) / elapsed, 1),
+            'errors': len(errors),
+            'latency': summary(every),
+            'endpoints': {path: summary(timings)
+                          for path, timings in latencies.items()}}
+
+
+def report(name, results):
+    latency = results['latency']
+    print(f'{name:<5} {results["requests_per_second"]:>9.1f} req/s '
+          f'{latency.get("p50_ms", 0.0):>8.2f} ms p50 '
+          f'{latency.get("p99_ms", 0.0):>8.2f} ms p99 '
+          f'{latency.get("max_ms", 0.0):>8.2f} ms max '
+          f'{results["errors"]:>5} errors')
+    for path, endpoint in results['endpoints'].items():
+        print(f'      {path:<18} {endpoint.get("p50_ms", 0.0):>8.2f} ms p50 '
+              f'{endpoint.get("p99_ms", 0.0):>8.2f} ms p99')
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ----------------------------------------------------------------------------#
+# Micro-benchmarks
+# ----------------------------------------------------------------------------#
+
+
+def time_calls(function, number):
+    timings = []
+    for _ in range(number):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return summary(timings)
+
+
+def micro_benchmarks(flask_app, token, number):
+    '''times verify_decode_jwt, Bird.format() and paginate_items'''
+    from operator import attrgetter
+    from flask import request
+    from app import paginate_items
+    from auth import verify_decode_jwt, token_cache
+    from models import db, Bird, BirdCard
+
+    def verify_uncached():
+        token_cache.clear()
+        verify_decode_jwt(token)
+
+    with flask_app.test_request_context('/birds?limit=100'):
+        bird = db.session.get(Bird, 1)
+        bird.format()
+        query = db.session.query(
+            BirdCard.bird_id, BirdCard.card).order_by(BirdCard.bird_id)
+        results = {
+            'verify_decode_jwt': time_calls(verify_uncached, number),
+            'verify_decode_jwt_cached': time_calls(
+                lambda: verify_decode_jwt(token), number),
+            'Bird.format': time_calls(bird.format, number),
+            'paginate_items': time_calls(
+                lambda: paginate_items(request, query, BirdCard.bird_id,
+                                       attrgetter('card')), number)}
+        db.session.remove()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test and micro-benchmarks of the app.')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--slow-clients', type=int, default=0,
+                        help='idle half-sent requests held during the run')
+    parser.add_argument('--threads', type=int, default=32,
+                        help='ASGI_THREADS of the ASGI server')
+    parser.add_argument('--servers', nargs='*', default=['wsgi', 'asgi'],
+                        choices=['wsgi', 'asgi'])
+    parser.add_argument('--birds', type=int, default=0,
+                        help='seed the database up to this many birds')
+    parser.add_argument('--micro', type=int, default=1000,
+                        help='calls of each micro-benchmark, 0 skips them')
+    parser.add_argument('--json', metavar='PATH',
+                        help='write the results as JSON, - for stdout')
+    args = parser.parse_args()
+
+    from mock_rsa_keys import create_test_token, mock_get_jwks
+    patch('auth.get_jwks', mock_get_jwks).start()
+    from app import create_app
+    from auth import AUTH0_DOMAIN, API_AUDIENCE, ALGORITHMS
+
+    database_path = os.environ.get('BENCHMARK_DATABASE_URL',
+                                   os.environ['TEST_DATABASE_URL'])
+    flask_app = create_app(database_path)
+    with flask_app.app_context():
+        birds = seed_birds(args.birds)
+    token = create_test_token({
+        'iss': f'https://{AUTH0_DOMAIN}/',
+        'sub': 'auth0|Benchmark',
+        'aud': API_AUDIENCE,
+        'iat': int(time.time()),
+        'exp': int(time.time() + 3600),
+        'permissions': ['get:birds', 'get:habitats', 'get:regions']},
+        algorithm=ALGORITHMS[0])
+    headers = {'Authorization': f'Bearer {token}'}
+
+    results = {'commit': commit(), 'python': platform.python_version(),
+               'birds': birds, 'args': vars(args), 'servers': {}}
+    print(f'{birds} birds, {args.requests} requests, {args.concurrency} '
+          f'clients, {args.slow_clients} slow clients')
+    for name in args.servers:
+        port = free_port()
+        if name == 'wsgi':
+            stop = start_wsgi(flask_app, port)
+        else:
+            stop = start_asgi(flask_app, port, args.threads)
+        wait_for_port(port)
+        slow = hold_slow_clients(port, args.slow_clients)
+        # warm up the caches so both servers are measured the same way
+        run_clients(port, headers, len(ENDPOINTS), 1)
+        results['servers'][name] = server_results(
+            *run_clients(port, headers, args.requests, args.concurrency))
+        report(name, results['servers'][name])
+        for sock in slow:
+            sock.close()
+        stop()
+
+    if args.micro:
+        results['micro'] = micro_benchmarks(flask_app, token, args.micro)
+        for name, timings in results['micro'].items():
+            print(f'{name:<25} {timings["mean_ms"] * 1000:>10.1f} us mean '
+                  f'{timings["p99_ms"] * 1000:>10.1f} us p99')
+
+    if args.json == '-':
+        print(json.dumps(results, indent=2))
+    elif args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import csv
+import io
+import json
+import os
+from collections import Counter
+from sqlalchemy import select, insert
+from sqlalchemy.exc import SQLAlchemyError
+from models import (db, Region, Habitat, Bird, bump_version,
+                    refresh_bird_cards, add_counts, recount_region_birds)
+from models import range as bird_range
+
+
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 500))
+
+
+# ----------------------------------------------------------------------------#
+# Parsing
+# ----------------------------------------------------------------------------#
+
+
+def parse_rows(text, content_type='application/x-ndjson'):
+    '''
+    parse_rows(text, content_type) reads CSV (text/csv), a JSON list
+    (application/json) or NDJSON into a list of (row number, dict or error).
+    CSV list columns (habitats, habitat_ids) are separated by ";".
+    '''
+    if 'csv' in content_type:
+        rows = []
+        reader = csv.DictReader(io.StringIO(text))
+        for number, row in enumerate(reader, start=1):
+            for column in ('habitats', 'habitat_ids'):
+                if row.get(column) is not None:
+                    row[column] = [item.strip() for item in
+                                   row[column].split(';') if item.strip()]
+            rows.append((number, row))
+        return rows
+
+    if 'ndjson' not in content_type and text.lstrip().startswith('['):
+        return list(enumerate(json.loads(text), start=1))
+
+    rows = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            rows.append((number, json.loads(line)))
+        except ValueError:
+            rows.append((number, 'invalid JSON'))
+    return rows
+
+
+# ----------------------------------------------------------------------------#
+# Loaders
+# ----------------------------------------------------------------------------#
+
+
+def lookup_key(value):
+    '''
+    ints are matched as ids and anything else as a name, case insensitively,
+    so a name made of digits is still a name
+    '''
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    return str(value).strip().lower()
+
+
+def id_key(value):
+    '''the values of the id columns (region_id, habitat_ids) are ids, CSV text too'''
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    return None
+
+
+def _insert_batches(rows, insert_batch, batch_size):
+    '''
+    _insert_batches commits every batch in one transaction. A batch that
+    fails (e.g. a concurrent duplicate) is retried row by row so only the
+    offending rows are reported.
+    '''
+    inserted, errors = 0, []
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        try:
+            insert_batch([values for _, values in batch])
+            db.session.commit()
+            inserted += len(batch)
+            continue
+        except SQLAlchemyError:
+            db.session.rollback()
+
+        for number, values in batch:
+            try:
+                insert_batch([values])
+                db.session.commit()
+                inserted += 1
+            except SQLAlchemyError:
+                db.session.rollback()
+                errors.append({'row': number, 'error': 'could not insert'})
+    return inserted, errors
+
+
+def load_habitats(rows, batch_size=BULK_BATCH_SIZE):
+    '''
+    load_habitats(rows, batch_size) inserts {name, region} rows, region is a
+    region id (int) or name, or {name, region_id} rows. Returns the number
+    inserted and the rejected rows.
+    '''
+    regions = {}
+    for region in db.session.execute(select(Region.id, Region.name)):
+        regions[region.id] = region.id
+        regions[region.name.lower()] = region.id
+    names = set(db.session.scalars(select(Habitat.name)))
+
+    valid, errors = [], []
+    for number, row in rows:
+        if not isinstance(row, dict):
+            errors.append({'row': number, 'error': row or 'invalid row'})
+            continue
+        name = row.get('name')
+        if row.get('region') is not None:
+            region = row['region']
+            region_key = lookup_key(region)
+        else:
+            region = row.get('region_id')
+            region_key = id_key(region)
+        if not name or region is None:
+            errors.append({'row': number, 'error': 'name and region are required'})
+        elif region_key not in regions:
+            errors.append({'row': number, 'error': f'unknown region {region}'})
+        elif name in names:
+            errors.append({'row': number, 'error': 'habitat already exist'})
+        else:
+            names.add(name)
+            valid.append((number, {
+                'name': name,
+                'region_id': regions[region_key]}))
+
+    def insert_batch(values):
+        db.session.execute(insert(Habitat.__table__), values)
+        # new habitats have no birds, only their regions' habitat_count moves
+        add_counts(db.session.connection(), region_deltas=Counter(
+            habitat['region_id'] for habitat in values))
+        bump_version(Habitat.__tablename__)
+
+    inserted, insert_errors = _insert_batches(valid, insert_batch, batch_size)
+    return {'inserted': inserted,
+            'errors': sorted(errors + insert_errors,
+                             key=lambda error: error['row'])}
+
+
+def load_birds(rows, batch_size=BULK_BATCH_SIZE):
+    '''
+    load_birds(rows, batch_size) inserts {common_name, species, habitats,
+    habitat_ids, image_link} rows, habitats are habitat ids (ints) or names
+    and habitat_ids ids, resolved from one preloaded map. Returns the number
+    inserted and the rejected rows.
+    '''
+    habitats = {}
+    for habitat in db.session.execute(select(Habitat.id, Habitat.name)):
+        habitats[habitat.id] = habitat.id
+        habitats[habitat.name.lower()] = habitat.id
+    names = set(db.session.scalars(select(Bird.common_name)))
+
+    valid, errors = [], []
+    for number, row in rows:
+        if not isinstance(row, dict):
+            errors.append({'row': number, 'error': row or 'invalid row'})
+            continue
+        common_name = row.get('common_name')
+        species = row.get('species')
+        bird_habitats = [
+            (habitat, lookup_key(habitat))
+            for habitat in row.get('habitats') or []] + [
+            (habitat, id_key(habitat))
+            for habitat in row.get('habitat_ids') or []]
+        unknown = [habitat for habitat, key in bird_habitats
+                   if key not in habitats]
+        if not common_name or not species or not bird_habitats:
+            errors.append({
+                'row': number,
+                'error': 'common_name, species and habitats are required'})
+        elif unknown:
+            errors.append({
+                'row': number,
+                'error': f'unknown habitats {", ".join(map(str, unknown))}'})
+        elif common_name in names:
+            errors.append({'row': number, 'error': 'duplicate bird resource'})
+        else:
+            names.add(common_name)
+            habitat_ids = {habitats[key] for _, key in bird_habitats}
+            valid.append((number, {
+                'common_name': common_name,
+                'species': species,
+                'image_link': row.get('image_link') or '',
+                'habitat_ids': sorted(habitat_ids)}))
+
+    def insert_batch(values):
+        bird_ids = db.session.scalars(
+            insert(Bird.__table__).returning(
+                Bird.__table__.c.id, sort_by_parameter_order=True),
+            [{key: value for key, value in bird.items()
+              if key != 'habitat_ids'} for bird in values]).all()
+        db.session.execute(insert(bird_range), [
+            {'bird_id': bird_id, 'habitat_id': habitat_id}
+            for bird_id, bird in zip(bird_ids, values)
+            for habitat_id in bird['habitat_ids']])
+        refresh_bird_cards(db.session.connection(), bird_ids)
+        habitat_deltas = Counter(habitat_id for bird in values
+                                 for habitat_id in bird['habitat_ids'])
+        add_counts(db.session.connection(), habitat_deltas)
+        recount_region_birds(db.session.connection(), set(habitat_deltas))
+        bump_version(Bird.__tablename__)
+
+    inserted, insert_errors = _insert_batches(valid, insert_batch, batch_size)
+    return {'inserted': inserted,
+            'errors': sorted(errors + insert_errors,
+                             key=lambda error: error['row'])}
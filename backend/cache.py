@@ -0,0 +1,240 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import current_app, request, g
+from models import get_versions
+from compress import negotiate_encoding
+
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 60))
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL', None)
+
+
+# ----------------------------------------------------------------------------#
+# Cache backends
+# ----------------------------------------------------------------------------#
+'''
+A backend stores response bodies under a request path, a variant (the
+query args) and the version of the tables they were read from, if any.
+invalidate(*paths) drops every variant of the given paths, a write that
+changes a version makes the entries of the old one unreachable anyway.
+'''
+
+
+class LRUResponseCache:
+    '''
+    LRUResponseCache
+    In-process LRU of response bodies. Entries expire after ttl seconds so
+    workers that did not see a write catch up (0 keeps them until evicted).
+    '''
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, variant, version=None):
+        key = (path, f'{variant}|{version}' if version else variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, path, variant, body, version=None):
+        if self.maxsize <= 0:
+            return
+        key = (path, f'{variant}|{version}' if version else variant)
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (body, expires_at)
+            self._entries.move_to_end(key)
+            self._variants.setdefault(path, set()).add(key[1])
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, *paths):
+        with self._lock:
+            for path in paths:
+                for variant in self._variants.pop(path, ()):
+                    self._entries.pop((path, variant), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._variants.clear()
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        variants = self._variants.get(key[0])
+        if variants is not None:
+            variants.discard(key[1])
+            if not variants:
+                del self._variants[key[0]]
+
+
+class RedisResponseCache:
+    '''
+    RedisResponseCache
+    Keeps every variant of a path in one redis hash so invalidating a path
+    is a single DEL shared by all workers. A versioned entry goes in the
+    hash of its path and version, so the hashes of old versions are no
+    longer written and expire after ttl. Any client with hget, hset,
+    expire, delete and scan_iter works (redis-py, fakeredis, ...).
+    '''
+
+    def __init__(self, client, prefix='botw:response:',
+                 ttl=RESPONSE_CACHE_TTL):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, path, version=None):
+        if version:
+            return f'{self.prefix}{path}@{version}'
+        return self.prefix + path
+
+    def get(self, path, variant, version=None):
+        return self.client.hget(self._key(path, version), variant)
+
+    def set(self, path, variant, body, version=None):
+        key = self._key(path, version)
+        self.client.hset(key, variant, body)
+        if self.ttl:
+            self.client.expire(key, self.ttl)
+
+    def invalidate(self, *paths):
+        if paths:
+            self.client.delete(*[self._key(path) for path in paths])
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def setup_cache(app, backend=None):
+    '''setup_cache(app) attaches a response cache to the flask application'''
+    if backend is None:
+        if RESPONSE_CACHE_URL:
+            import redis
+            backend = RedisResponseCache(
+                redis.Redis.from_url(RESPONSE_CACHE_URL))
+        else:
+            backend = LRUResponseCache()
+    app.extensions['response_cache'] = backend
+    return backend
+
+
+# ----------------------------------------------------------------------------#
+# Decorators
+# ----------------------------------------------------------------------------#
+
+
+def request_variant():
+    '''request_variant() is the query args of the request in a stable order'''
+    return urlencode(sorted(request.args.items(multi=True)))
+
+
+def conditional_response(*table_names):
+    '''
+    conditional_response(*table_names) gives a GET handler a strong ETag and
+    Last-Modified built from the versions of the tables it reads. A matching
+    If-None-Match (or If-Modified-Since) is answered with 304 before the
+    handler runs. Goes below requires_auth and above cached_response.
+    '''
+    def conditional_response_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            versions = get_versions(*table_names)
+            # read again by reference_rows during the request
+            g.setdefault('table_versions', {}).update(versions)
+            tag = ','.join(f'{table_name}:{versions[table_name][0]}'
+                           for table_name in table_names)
+            etag = hashlib.sha1(
+                f'{request.path}?{request_variant()}|{tag}'.encode()
+            ).hexdigest()
+            modified = [updated_at for _, updated_at in versions.values()
+                        if updated_at is not None]
+            last_modified = max(modified).replace(
+                microsecond=0) if modified else None
+
+            if request.if_none_match:
+                # a compressed response carries the weak form of the tag
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = (request.if_modified_since is not None and
+                                last_modified is not None and
+                                last_modified <= request.if_modified_since)
+
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                # cached bodies are only reused for the same table versions
+                g.response_version = tag
+                response = f(*args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+        return wrapper
+    return conditional_response_decorator
+
+
+def cached_response(f):
+    '''
+    cached_response serves a GET handler from the response cache keyed by
+    path, query args and (under conditional_response) the table versions.
+    Goes below requires_auth so permissions are still checked on every
+    request. Only 200 responses are stored, compress_response adds their
+    compressed bytes under variant|encoding.
+    '''
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        cache = current_app.extensions.get('response_cache')
+        if cache is None:
+            return f(*args, **kwargs)
+
+        variant = request_variant()
+        version = g.get('response_version')
+
+        encoding = negotiate_encoding()
+        if encoding is not None:
+            body = cache.get(request.path, f'{variant}|{encoding}', version)
+            if body is not None:
+                response = current_app.response_class(
+                    body, mimetype='application/json')
+                response.headers['Content-Encoding'] = encoding
+                return response
+
+        body = cache.get(request.path, variant, version)
+        if body is not None:
+            g.response_cache_key = (request.path, variant, version)
+            return current_app.response_class(
+                body, mimetype='application/json')
+
+        response = f(*args, **kwargs)
+        if response.status_code == 200:
+            cache.set(request.path, variant, response.get_data(), version)
+            g.response_cache_key = (request.path, variant, version)
+        return response
+    return wrapper
+
+
+def invalidate_responses(*paths):
+    '''invalidate_responses(*paths) drops the cached responses of the paths'''
+    cache = current_app.extensions.get('response_cache')
+    if cache is not None:
+        cache.invalidate(*paths)
@@ -0,0 +1,99 @@
+import gzip
+import os
+import zlib
+from flask import current_app, request, g
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+COMPRESS_ENCODINGS = [encoding.strip() for encoding in os.environ.get(
+    'COMPRESS_ENCODINGS', 'br,gzip').split(',') if encoding.strip()]
+COMPRESS_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv'}
+
+
+def available_encodings():
+    '''available_encodings() are the COMPRESS_ENCODINGS this server can write'''
+    return [encoding for encoding in COMPRESS_ENCODINGS
+            if encoding == 'gzip' or (encoding == 'br' and brotli is not None)]
+
+
+def negotiate_encoding():
+    '''negotiate_encoding() is the encoding the client accepts, or None'''
+    encodings = available_encodings()
+    if not encodings or not request.accept_encodings:
+        return None
+    # best_match prefers the first of our encodings on equal quality
+    return request.accept_encodings.best_match(encodings)
+
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+
+def compress_stream(chunks, encoding):
+    '''compress_stream(chunks, encoding) compresses a streamed body chunk by chunk'''
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        # wbits 31 writes the gzip header and trailer
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(
+                zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+def compress_response(response):
+    '''
+    compress_response(response) compresses JSON, NDJSON and CSV responses of
+    at least COMPRESS_MIN_SIZE bytes (streams always) with the encoding the
+    client prefers. Bodies served by cached_response are stored compressed
+    in the response cache too, so a hot response is compressed only once.
+    A 304 gets the Vary and ETag of the 200 it stands for.
+    '''
+    not_modified = response.status_code == 304
+    if response.mimetype not in COMPRESS_MIMETYPES and not not_modified:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    if ('Content-Encoding' not in response.headers and
+            response.status_code == 200 and not response.direct_passthrough):
+        if response.is_streamed:
+            response.response = compress_stream(
+                response.iter_encoded(), encoding)
+            response.headers.pop('Content-Length', None)
+            response.headers['Content-Encoding'] = encoding
+        elif len(response.get_data()) >= COMPRESS_MIN_SIZE:
+            data = compress_body(response.get_data(), encoding)
+            response.set_data(data)
+            cache_key = g.get('response_cache_key')
+            cache = current_app.extensions.get('response_cache')
+            if cache_key is not None and cache is not None:
+                path, variant, version = cache_key
+                cache.set(path, f'{variant}|{encoding}', data, version)
+            response.headers['Content-Encoding'] = encoding
+
+    # the representation depends on the encoding, compressed or not (the
+    # size is unknown to a 304), so the tag is always the weak form
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,89 @@
+import csv
+import io
+import json
+import os
+from sqlalchemy import select
+from models import db, Region, Habitat, BirdCard
+
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'}
+
+
+# ----------------------------------------------------------------------------#
+# Rows
+# ----------------------------------------------------------------------------#
+
+
+def bird_rows():
+    '''
+    bird_rows() yields every bird in the shape of Bird.format(), read from
+    the bird cards through a server-side cursor, EXPORT_BATCH_SIZE at a time
+    '''
+    rows = db.session.execute(
+        select(BirdCard.card).order_by(BirdCard.bird_id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for row in rows:
+        yield row.card
+
+
+def habitat_rows():
+    '''habitat_rows() yields every habitat with the name of its region'''
+    rows = db.session.execute(
+        select(Habitat.id, Habitat.name, Habitat.region_id,
+               Region.name.label('region'))
+        .join(Region, Region.id == Habitat.region_id)
+        .order_by(Habitat.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for row in rows:
+        yield {
+            'id': row.id,
+            'name': row.name,
+            'region_id': row.region_id,
+            'region': row.region}
+
+
+# ----------------------------------------------------------------------------#
+# Formats
+# ----------------------------------------------------------------------------#
+
+
+def bird_csv_row(bird):
+    return {
+        **bird,
+        'habitats': ';'.join(habitat['name'] for habitat in bird['habitats']),
+        'regions': ';'.join(region['name'] for region in bird['regions'])}
+
+
+CSV_COLUMNS = {
+    'birds': (['id', 'common_name', 'species', 'image_link', 'habitats',
+               'regions'], bird_csv_row),
+    'habitats': (['id', 'name', 'region_id', 'region'], lambda row: row)}
+
+
+def stream_export(kind, export_format):
+    '''
+    stream_export(kind, export_format) yields the birds or habitats as
+    NDJSON or CSV text, in chunks of EXPORT_BATCH_SIZE rows
+    '''
+    rows = bird_rows() if kind == 'birds' else habitat_rows()
+    buffer = io.StringIO()
+    writer = None
+    if export_format == 'csv':
+        columns, to_csv = CSV_COLUMNS[kind]
+        writer = csv.DictWriter(buffer, fieldnames=columns)
+        writer.writeheader()
+
+    for count, row in enumerate(rows, start=1):
+        if writer is None:
+            buffer.write(json.dumps(row) + '\n')
+        else:
+            writer.writerow(to_csv(row))
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
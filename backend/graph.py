@@ -0,0 +1,48 @@
+from sqlalchemy import and_, func, select
+from models import db, Habitat, BirdCard
+from models import range as bird_range
+
+
+'''
+Aggregate queries over the bird-habitat graph (the range table). They
+return session queries for paginate_items and count_items, ordered so the
+pages are stable.
+'''
+
+
+def region_birds_query(region_id):
+    '''region_birds_query(region_id) are the cards of the birds of a region'''
+    bird_ids = (select(bird_range.c.bird_id)
+                .join(Habitat, Habitat.id == bird_range.c.habitat_id)
+                .where(Habitat.region_id == region_id))
+    return db.session.query(BirdCard.bird_id, BirdCard.card).filter(
+        BirdCard.bird_id.in_(bird_ids)).order_by(BirdCard.bird_id)
+
+
+def related_birds_query(bird_id, min_shared=1):
+    '''
+    related_birds_query(bird_id, min_shared) are the cards of the birds that
+    share at least min_shared habitats with the bird, most shared first
+    '''
+    mine = bird_range.alias('mine')
+    other = bird_range.alias('other')
+    shared = (select(other.c.bird_id,
+                     func.count().label('shared_habitats'))
+              .select_from(mine.join(other, and_(
+                  other.c.habitat_id == mine.c.habitat_id,
+                  other.c.bird_id != mine.c.bird_id)))
+              .where(mine.c.bird_id == bird_id)
+              .group_by(other.c.bird_id)
+              .having(func.count() >= min_shared)
+              .subquery())
+    return (db.session.query(BirdCard.card, shared.c.shared_habitats)
+            .join(shared, shared.c.bird_id == BirdCard.bird_id)
+            .order_by(shared.c.shared_habitats.desc(), BirdCard.bird_id))
+
+
+def habitat_stats_query():
+    '''habitat_stats_query() are the habitats by their number of birds'''
+    # the maintained counter, not a count over range
+    return (db.session.query(Habitat.id, Habitat.name, Habitat.region_id,
+                             Habitat.bird_count)
+            .order_by(Habitat.bird_count.desc(), Habitat.id))
@@ -0,0 +1,86 @@
+import dataclasses
+import math
+import re
+from flask.json.provider import DefaultJSONProvider
+from profiling import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# characters json.dumps escapes with ensure_ascii
+NON_ASCII = re.compile('[^\x00-\x7e]')
+SCALARS = frozenset([str, int, bool, type(None)])
+
+
+def has_odd_float(obj):
+    '''
+    has_odd_float(obj) tells whether obj holds a float orjson writes unlike
+    json.dumps: one repr writes with an exponent (1e-05 and 1e+16, orjson
+    writes 0.00001 and 1e16) or a NaN/Infinity (orjson writes null)
+    '''
+    kind = type(obj)
+    if kind in SCALARS:
+        return False
+    if kind is dict or isinstance(obj, dict):
+        values = obj.values()
+    elif kind is list or isinstance(obj, (list, tuple)):
+        values = obj
+    elif isinstance(obj, float):
+        return not math.isfinite(obj) or 'e' in repr(obj)
+    elif dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        values = [getattr(obj, field.name)
+                  for field in dataclasses.fields(obj)]
+    else:
+        # dates, decimals... are written by default() as strings
+        return False
+    # the strings and ints of the page are skipped without a call
+    for value in values:
+        if type(value) not in SCALARS and has_odd_float(value):
+            return True
+    return False
+
+
+def escape_non_ascii(match):
+    code = ord(match.group())
+    if code > 0xffff:
+        code -= 0x10000
+        return '\\u%04x\\u%04x' % (0xd800 | code >> 10, 0xdc00 | code & 0x3ff)
+    return '\\u%04x' % code
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    '''
+    ORJSONProvider
+    Serializes the compact JSON responses with orjson, byte for byte the same
+    as the default provider (sorted keys, ASCII only). Values orjson writes
+    differently or cannot write, and the indented debug output, go through
+    the default provider.
+    '''
+
+    def dumps_compact(self, obj):
+        '''dumps_compact(obj) is the compact JSON of obj, None if orjson cannot'''
+        # decided on the values, the output has strings that look like floats
+        if orjson is None or has_odd_float(obj):
+            return None
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            data = orjson.dumps(obj, default=self.default, option=option)
+        except TypeError:
+            return None
+        if not self.ensure_ascii or (data.isascii() and b'\x7f' not in data):
+            return data
+        return NON_ASCII.sub(escape_non_ascii, data.decode()).encode()
+
+    @timed('serialize')
+    def response(self, *args, **kwargs):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        data = self.dumps_compact(self._prepare_response_obj(args, kwargs))
+        if data is None:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(data + b'\n', mimetype=self.mimetype)
@@ -3,12 +3,15 @@ import unittest
 from unittest.mock import patch
 import json
 from app import create_app
-from models import Bird, Habitat
+from models import Bird, Habitat, rollback_transaction
+from seeding import isolated_database_url
 from functools import wraps
 
 database_path = os.environ['TEST_DATABASE_URL']
 if database_path.startswith('postgres://'):
     database_path = database_path.replace('postgres://', 'postgresql://', 1)
+# every parallel test process gets a database of its own
+database_path = isolated_database_url(database_path)
 
 
 def mock_auth_decorator(permission):
@@ -27,10 +30,21 @@ patch('app.requires_auth', mock_auth_decorator).start()
 class BirdsOfTWorldsTestWithoutAuthCase(unittest.TestCase):
     '''This class represents the birds of the world test case without authenication'''
 
+    @classmethod
+    def setUpClass(cls):
+        cls.seeded_app = create_app(database_path)
+
     def setUp(self):
         '''Define test variables and initialize app.'''
 
-        self.app = create_app(database_path)
+        # one seeded database, the writes of each test are rolled back
+        self.app = self.seeded_app
+        transaction = rollback_transaction(self.app)
+        transaction.__enter__()
+        self.addCleanup(transaction.__exit__, None, None, None)
+        self.app.extensions['response_cache'].clear()
+        self.app.extensions.pop('search_index', None)
+        self.app.extensions.pop('reference_data', None)
         self.client = self.app.test_client
         self.post_bird_success = {
             'common_name': 'European Robin',
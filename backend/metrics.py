@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+
+METRICS_ENABLED = os.environ.get(
+    'METRICS_ENABLED', 'false').lower() in ('true', '1')
+
+
+class PoolMetrics:
+    '''
+    PoolMetrics
+    Counts the connections of the pool of an engine from its events and
+    times how long checkouts wait for a free connection, with the pool
+    class of timed_pool_class.
+    '''
+
+    def __init__(self):
+        self.engine = None
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidated = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.waits = 0
+        self._lock = threading.Lock()
+
+    def listen(self, engine):
+        self.engine = engine
+        event.listen(engine, 'connect', self.on_connect)
+        event.listen(engine, 'checkout', self.on_checkout)
+        event.listen(engine, 'checkin', self.on_checkin)
+        event.listen(engine, 'invalidate', self.on_invalidate)
+
+    def timed_pool_class(self, database_url):
+        '''
+        timed_pool_class(database_url) is a QueuePool reporting its waits to
+        these metrics, None when the database does not use a QueuePool. The
+        pool has no event before a checkout, and a subclass (unlike a patched
+        pool) is kept when the engine recreates its pool.
+        '''
+        url = make_url(database_url)
+        if url.get_dialect().get_pool_class(url) is not QueuePool:
+            return None
+        metrics = self
+        connecting = threading.local()
+
+        class TimedQueuePool(QueuePool):
+            def _do_get(self):
+                connecting.seconds = 0.0
+                start = time.perf_counter()
+                try:
+                    return super()._do_get()
+                finally:
+                    # only the engine's pool, the replicas share the options
+                    if metrics.engine is not None and metrics.engine.pool is self:
+                        metrics.on_wait(
+                            time.perf_counter() - start - connecting.seconds)
+
+            def _create_connection(self):
+                # opening a connection is not waiting for one
+                start = time.perf_counter()
+                try:
+                    return super()._create_connection()
+                finally:
+                    connecting.seconds += time.perf_counter() - start
+
+        return TimedQueuePool
+
+    def on_wait(self, waited):
+        with self._lock:
+            self.waits += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record,
+                    connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins += 1
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidated += 1
+
+    def stats(self):
+        pool = self.engine.pool
+        with self._lock:
+            stats = {
+                'pool': type(pool).__name__,
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'invalidated': self.invalidated,
+                'wait_avg_ms': round(
+                    self.wait_total / self.waits * 1000, 3) if self.waits
+                else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 3)}
+        # QueuePool reports its size, the other pools only the counters
+        for name in ['size', 'checkedin', 'checkedout', 'overflow']:
+            if hasattr(pool, name):
+                stats[name] = getattr(pool, name)()
+        if hasattr(pool, '_max_overflow'):
+            stats['max_overflow'] = pool._max_overflow
+        if hasattr(pool, '_timeout'):
+            stats['timeout'] = pool._timeout
+        return stats
+
+
+def setup_metrics(app, database_url):
+    '''
+    setup_metrics(app, database_url) makes the engine of the app, created
+    next by setup_db, use the timed pool; PoolMetrics.listen counts it
+    '''
+    metrics = PoolMetrics()
+    app.extensions['pool_metrics'] = metrics
+    pool_class = metrics.timed_pool_class(database_url)
+    if pool_class is not None:
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})[
+            'poolclass'] = pool_class
+    return metrics
@@ -1,42 +1,238 @@
 import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import groupby, islice
+from operator import attrgetter
+from flask import current_app, g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import (select, update, insert, delete, event, inspect, func,
+                        bindparam, DDL)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.schema import CreateColumn
+from routing import RoutingSession, replica_binds
+from profiling import timed
 
 # ----------------------------------------------------------------------------#
 # Database setup
 # ----------------------------------------------------------------------------#
-database_path = os.environ['DATABASE_URL']
-if database_path.startswith('postgres://'):
-    database_path = database_path.replace('postgres://', 'postgresql://', 1)
 
-db = SQLAlchemy()
 
+def database_url(url):
+    if url.startswith('postgres://'):
+        url = url.replace('postgres://', 'postgresql://', 1)
+    return url
 
-def setup_db(app, database_path=database_path):
-    '''setup_db(app) binds a flask application and a SQLAlchemy service'''
+
+def default_database_path():
+    '''default_database_path() is DATABASE_URL, read when an app is set up'''
+    return database_url(os.environ['DATABASE_URL'])
+
+
+# comma separated read replicas of DATABASE_URL, used by the GET endpoints
+REPLICA_PATHS = [database_url(url.strip()) for url in os.environ.get(
+    'DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# DB_* variables -> create_engine pool arguments, only the ones set are used
+POOL_SETTINGS = {
+    'DB_POOL_SIZE': ('pool_size', int),
+    'DB_MAX_OVERFLOW': ('max_overflow', int),
+    'DB_POOL_TIMEOUT': ('pool_timeout', float),
+    'DB_POOL_RECYCLE': ('pool_recycle', int),
+    'DB_POOL_PRE_PING': ('pool_pre_ping',
+                         lambda value: value.lower() in ('true', '1')),
+}
+
+
+def pool_options(environ=os.environ):
+    '''pool_options() reads the pool settings of the engine from DB_* variables'''
+    options = {}
+    for variable, (option, convert) in POOL_SETTINGS.items():
+        if environ.get(variable):
+            options[option] = convert(environ[variable])
+    return options
+
+
+def setup_db(app, database_path=None, replica_paths=None):
+    '''
+    setup_db(app) binds a flask application and a SQLAlchemy service. The
+    schema is not touched, "flask init-db" (init_db) creates it.
+    '''
+    if database_path is None:
+        database_path = default_database_path()
+    if replica_paths is None:
+        replica_paths = REPLICA_PATHS
     app.config['SQLALCHEMY_DATABASE_URI'] = database_path
+    app.config['SQLALCHEMY_BINDS'] = replica_binds(replica_paths)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **pool_options(), **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})}
     db.app = app
     db.init_app(app)
     with app.app_context():
-        # db.drop_all()
-        db.create_all()
+        if db.engine.dialect.name == 'sqlite':
+            enable_sqlite_savepoints(db.engine)
+
+
+def init_db():
+    '''
+    init_db() creates the missing tables, columns and indexes, the bird
+    cards and the counters
+    '''
+    # the tables are only created on the primary, replicas copy them
+    db.create_all(bind_key=None)
+    # create_all skips existing tables, add the columns and indexes added since
+    added_columns = add_missing_columns(db.engine)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    backfill_bird_cards()
+    if added_columns:
+        refresh_counts(db.session.connection())
+        db.session.commit()
+
+
+def add_missing_columns(engine):
+    '''
+    add_missing_columns(engine) adds the columns of the models missing from
+    their existing tables, they need a server_default or to be nullable
+    '''
+    added = []
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in
+                        inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                connection.exec_driver_sql(
+                    f'ALTER TABLE "{table.name}" ADD COLUMN {column_ddl}')
+                added.append(f'{table.name}.{column.name}')
+    return added
+
+
+def enable_sqlite_savepoints(engine):
+    '''
+    pysqlite starts and ends transactions on its own, which breaks
+    SAVEPOINT (used by /batch). Let SQLAlchemy emit BEGIN itself instead.
+    '''
+    @event.listens_for(engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def do_begin(conn):
+        conn.exec_driver_sql('BEGIN')
+
+
+# pg_trgm provides the trigram indexes used by the search
+event.listen(db.metadata, 'before_create', DDL(
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+
+def trigram_index(name, column):
+    '''trigram_index(name, column) is a GIN trigram index, Postgres only'''
+    return db.Index(name, column, postgresql_using='gin',
+                    postgresql_ops={column: 'gin_trgm_ops'}).ddl_if(
+                        dialect='postgresql')
 
 
 def test_db(app):
     with app.app_context():
-        db.drop_all()
-        db.create_all()
+        db.drop_all(bind_key=None)
+        db.create_all(bind_key=None)
+
+
+@contextmanager
+def rollback_transaction(app):
+    '''
+    rollback_transaction(app) runs the block in a transaction that is rolled
+    back at the end, the commits of the app only release savepoints. Lets
+    tests share one seeded database instead of recreating it.
+    '''
+    with app.app_context():
+        connection = db.engine.connect()
+    transaction = connection.begin()
+    app.extensions['session_connection'] = connection
+    try:
+        yield connection
+    finally:
+        del app.extensions['session_connection']
+        transaction.rollback()
+        connection.close()
+
+
+def upsert(dialect, table):
+    '''
+    upsert(dialect, table) is the INSERT of the dialect, whose
+    on_conflict_do_update makes concurrent writes of a key update the row
+    '''
+    return {'postgresql': postgresql.insert,
+            'sqlite': sqlite.insert}[dialect.name](table)
+
+
+# ----------------------------------------------------------------------------#
+# Table versions
+# ----------------------------------------------------------------------------#
+
+
+class TableVersion(db.Model):
+    '''TableVersion counts the writes to a table, used for ETags'''
+    __tablename__ = 'TableVersions'
+
+    table_name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+
+def bump_version(*table_names):
+    '''bump_version(*table_names) increments the versions in the current transaction'''
+    versions = TableVersion.__table__
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    for table_name in table_names:
+        # the first write of a table inserts its row, even concurrently
+        statement = upsert(db.engine.dialect, versions).values(
+            table_name=table_name, version=1, updated_at=now)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[versions.c.table_name],
+            set_={'version': versions.c.version + 1,
+                  'updated_at': statement.excluded.updated_at}))
+    if has_app_context():
+        # reference_rows reads these tables from the database from now on
+        g.setdefault('written_tables', set()).update(table_names)
+
+
+def get_versions(*table_names):
+    '''get_versions(*table_names) maps each table to (version, updated_at)'''
+    versions = TableVersion.__table__
+    rows = db.session.execute(
+        select(versions.c.table_name, versions.c.version,
+               versions.c.updated_at)
+        .where(versions.c.table_name.in_(table_names))).all()
+    found = {row.table_name: (row.version, row.updated_at.replace(
+        tzinfo=timezone.utc)) for row in rows}
+    return {table_name: found.get(table_name, (0, None))
+            for table_name in table_names}
 
 
 # ----------------------------------------------------------------------------#
 # Models
 # ----------------------------------------------------------------------------#
 '''Habitat to Bird is many to many Relationship'''
+# the primary key indexes (habitat_id, bird_id), the birds of a habitat;
+# ix_range_bird_id_habitat_id the other way, the habitats of a bird
 range = db.Table('range',
                  db.Column('habitat_id', db.Integer, db.ForeignKey(
                      'Habitats.id'), primary_key=True),
                  db.Column('bird_id', db.Integer, db.ForeignKey(
-                     'Birds.id'), primary_key=True)
+                     'Birds.id'), primary_key=True),
+                 db.Index('ix_range_bird_id_habitat_id',
+                          'bird_id', 'habitat_id')
                  )
 
 
@@ -47,6 +243,11 @@ class Region(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False, unique=True)
     image_link = db.Column(db.String(500))
+    # counters kept by refresh_counts, bird_count counts distinct birds
+    habitat_count = db.Column(db.Integer, nullable=False, default=0,
+                              server_default='0')
+    bird_count = db.Column(db.Integer, nullable=False, default=0,
+                           server_default='0')
     habitats = db.relationship(
         'Habitat', backref=db.backref('habitat_region', lazy=True))
 
@@ -56,8 +257,10 @@ class Region(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_version(self.__tablename__)
         db.session.commit()
 
+    @timed('format')
     def format(self):
         return {
             'id': self.id,
@@ -68,11 +271,15 @@ class Region(db.Model):
 class Habitat(db.Model):
     '''Habitat have name and region_id'''
     __tablename__ = 'Habitats'
+    __table_args__ = (trigram_index('ix_habitats_name_trgm', 'name'),)
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False, unique=True)
     region_id = db.Column(db.Integer, db.ForeignKey(
-        'Regions.id'), nullable=False)
+        'Regions.id'), nullable=False, index=True)
+    # counter kept by refresh_counts
+    bird_count = db.Column(db.Integer, nullable=False, default=0,
+                           server_default='0')
 
     def __init__(self, name, region_id):
         self.name = name
@@ -80,25 +287,34 @@ class Habitat(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_version(self.__tablename__)
         db.session.commit()
 
     def update(self):
+        bump_version(self.__tablename__)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_version(self.__tablename__)
         db.session.commit()
 
+    @timed('format')
     def format(self):
         return {
             'id': self.id,
             'name': self.name,
-            'region_id': self.region_id}
+            'region_id': self.region_id,
+            'bird_count': self.bird_count}
 
 
 class Bird(db.Model):
     '''Bird have common_name, species, image and habitats'''
     __tablename__ = 'Birds'
+    __table_args__ = (
+        trigram_index('ix_birds_common_name_trgm', 'common_name'),
+        trigram_index('ix_birds_species_trgm', 'species'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     common_name = db.Column(db.String, nullable=False, unique=True)
@@ -114,25 +330,33 @@ class Bird(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_version(self.__tablename__)
         db.session.commit()
 
     def update(self):
+        bump_version(self.__tablename__)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_version(self.__tablename__)
         db.session.commit()
 
     # Formatting the data that is displayed when listing Birds
+    @timed('format')
     def format(self):
         # formatting habitats
         habitats = [{'name': item.name, 'id': item.id}
                     for item in self.habitats]
-        regions = []
-        [regions.append(reg.habitat_region)
-         for reg in self.habitats if reg.habitat_region not in regions]
+        # regions de-duplicated by id in the order of the habitats
+        cached_regions = reference_rows('Regions') or {}
+        regions = {}
+        for habitat in self.habitats:
+            if habitat.region_id not in regions:
+                regions[habitat.region_id] = cached_regions.get(
+                    habitat.region_id) or habitat.habitat_region
         region_info = [{'name': item.name, 'image': item.image_link}
-                       for item in regions]
+                       for item in regions.values()]
 
         return {
             'id': self.id,
@@ -141,3 +365,384 @@ class Bird(db.Model):
             'image_link': self.image_link,
             'habitats': habitats,
             'regions': region_info}
+
+
+# ----------------------------------------------------------------------------#
+# Reference data
+# ----------------------------------------------------------------------------#
+'''
+Regions and Habitats are small lookup tables. Their rows are kept in memory
+by each app and reused until the version of the table changes, which also
+picks up the writes of the other workers. A request that wrote one of them
+reads it from the database for the rest of the request. The habitat rows
+carry bird_count, so they also follow the version of Birds.
+'''
+REFERENCE_COLUMNS = {
+    'Regions': (Region.id, Region.name, Region.image_link),
+    'Habitats': (Habitat.id, Habitat.name, Habitat.region_id,
+                 Habitat.bird_count),
+}
+# the tables whose writes change the rows
+REFERENCE_TABLES = {
+    'Regions': ('Regions',),
+    'Habitats': ('Habitats', 'Birds'),
+}
+
+_reference_lock = threading.Lock()
+
+
+class ReferenceTable:
+    '''ReferenceTable maps the ids of a table to its rows at one version'''
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.rows = {row.id: row for row in rows}
+
+
+def table_version(table_name):
+    '''table_version(table_name) is the version of a table, read once a request'''
+    versions = g.setdefault('table_versions', {})
+    if table_name not in versions:
+        versions.update(get_versions(table_name))
+    return versions[table_name][0]
+
+
+def reference_rows(table_name):
+    '''
+    reference_rows(table_name) maps the ids of Regions or Habitats to their
+    rows, None when the current request wrote the tables they follow
+    '''
+    written_tables = g.get('written_tables', ())
+    if any(name in written_tables for name in REFERENCE_TABLES[table_name]):
+        return None
+    version = tuple(table_version(name)
+                    for name in REFERENCE_TABLES[table_name])
+    tables = current_app.extensions.setdefault('reference_data', {})
+    table = tables.get(table_name)
+    if table is None or table.version != version:
+        with _reference_lock:
+            table = tables.get(table_name)
+            if table is None or table.version != version:
+                rows = db.session.execute(
+                    select(*REFERENCE_COLUMNS[table_name])).all()
+                table = tables[table_name] = ReferenceTable(version, rows)
+    return table.rows
+
+
+# ----------------------------------------------------------------------------#
+# Bird cards
+# ----------------------------------------------------------------------------#
+'''
+A bird card is Bird.format() stored as JSON in BirdCards, so the bird
+endpoints read one row per bird. The cards of the birds touched by a flush
+(the bird, its habitats, a habitat or region it shows) are rebuilt in the
+same transaction. Core inserts (bulk.py) call refresh_bird_cards themselves.
+'''
+BIRD_CARD_BATCH_SIZE = 1000
+
+
+class BirdCard(db.Model):
+    '''BirdCard is the ready to serve Bird.format() of a bird'''
+    __tablename__ = 'BirdCards'
+
+    bird_id = db.Column(db.Integer, primary_key=True)
+    card = db.Column(db.JSON, nullable=False)
+
+
+def bird_card_query():
+    '''bird_card_query() selects birds with their habitats and regions, a row each'''
+    return (
+        select(Bird.id, Bird.common_name, Bird.species, Bird.image_link,
+               Habitat.id.label('habitat_id'),
+               Habitat.name.label('habitat_name'),
+               Region.id.label('region_id'),
+               Region.name.label('region_name'),
+               Region.image_link.label('region_image'))
+        .select_from(Bird)
+        .outerjoin(range, range.c.bird_id == Bird.id)
+        .outerjoin(Habitat, Habitat.id == range.c.habitat_id)
+        .outerjoin(Region, Region.id == Habitat.region_id)
+        .order_by(Bird.id, Habitat.id))
+
+
+def bird_cards(rows):
+    '''bird_cards(rows) groups the rows of bird_card_query() into cards'''
+    for _, bird_habitats in groupby(rows, key=attrgetter('id')):
+        bird_habitats = list(bird_habitats)
+        bird = bird_habitats[0]
+        regions = {}
+        for row in bird_habitats:
+            if row.region_id is not None and row.region_id not in regions:
+                regions[row.region_id] = {
+                    'name': row.region_name, 'image': row.region_image}
+        yield {
+            'id': bird.id,
+            'common_name': bird.common_name,
+            'species': bird.species,
+            'image_link': bird.image_link,
+            'habitats': [{'name': row.habitat_name, 'id': row.habitat_id}
+                         for row in bird_habitats
+                         if row.habitat_id is not None],
+            'regions': list(regions.values())}
+
+
+def refresh_bird_cards(connection, bird_ids=None):
+    '''
+    refresh_bird_cards(connection, bird_ids) rebuilds the cards of the birds
+    (all of them when bird_ids is None), a deleted bird loses its card
+    '''
+    cards_table = BirdCard.__table__
+    query = bird_card_query()
+    # the cards of the birds that are gone
+    delete_cards = delete(cards_table).where(
+        cards_table.c.bird_id.not_in(select(Bird.id)))
+    if bird_ids is not None:
+        bird_ids = sorted(bird_ids)
+        if not bird_ids:
+            return
+        query = query.where(Bird.id.in_(bird_ids))
+        delete_cards = delete_cards.where(cards_table.c.bird_id.in_(bird_ids))
+
+    connection.execute(delete_cards)
+    # upserted, so concurrent rebuilds of a card do not collide on bird_id
+    insert_cards = upsert(connection.dialect, cards_table)
+    insert_cards = insert_cards.on_conflict_do_update(
+        index_elements=[cards_table.c.bird_id],
+        set_={'card': insert_cards.excluded.card})
+    cards = bird_cards(connection.execute(query))
+    while True:
+        batch = [{'bird_id': card['id'], 'card': card}
+                 for card in islice(cards, BIRD_CARD_BATCH_SIZE)]
+        if not batch:
+            break
+        connection.execute(insert_cards, batch)
+
+
+def _changed(instance, *attributes):
+    state = inspect(instance)
+    return any(state.attrs[attribute].history.has_changes()
+               for attribute in attributes)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def collect_bird_cards(session, flush_context, instances):
+    '''remembers the birds whose card the flush changes'''
+    bird_ids = session.info.setdefault('bird_card_ids', set())
+    new_birds = session.info.setdefault('bird_card_new', [])
+    habitat_ids, region_ids = set(), set()
+
+    for instance in session.new:
+        if isinstance(instance, Bird):
+            new_birds.append(instance)
+        elif isinstance(instance, Habitat):
+            new_birds.extend(instance.Birds)
+    for instance in session.dirty:
+        if isinstance(instance, Bird):
+            bird_ids.add(instance.id)
+        elif isinstance(instance, Habitat) and _changed(
+                instance, 'name', 'region_id'):
+            habitat_ids.add(instance.id)
+        elif isinstance(instance, Region) and _changed(
+                instance, 'name', 'image_link'):
+            region_ids.add(instance.id)
+    for instance in session.deleted:
+        if isinstance(instance, Bird):
+            bird_ids.add(instance.id)
+        elif isinstance(instance, Habitat):
+            habitat_ids.add(instance.id)
+
+    # the range rows are read before the flush deletes them
+    connection = session.connection()
+    if region_ids:
+        habitat_ids.update(connection.scalars(
+            select(Habitat.id).where(Habitat.region_id.in_(region_ids))))
+    if habitat_ids:
+        bird_ids.update(connection.scalars(
+            select(range.c.bird_id).where(range.c.habitat_id.in_(habitat_ids))))
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def refresh_flushed_bird_cards(session, flush_context):
+    bird_ids = session.info.pop('bird_card_ids', set())
+    bird_ids.update(bird.id for bird in session.info.pop('bird_card_new', []))
+    bird_ids.discard(None)
+    refresh_bird_cards(session.connection(), bird_ids)
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def forget_bird_cards(session, previous_transaction):
+    session.info.pop('bird_card_ids', None)
+    session.info.pop('bird_card_new', None)
+
+
+def backfill_bird_cards():
+    '''backfill_bird_cards() builds the cards of a database that has none yet'''
+    if (db.session.scalar(select(BirdCard.bird_id).limit(1)) is None and
+            db.session.scalar(select(Bird.id).limit(1)) is not None):
+        refresh_bird_cards(db.session.connection())
+        db.session.commit()
+
+
+# ----------------------------------------------------------------------------#
+# Counters
+# ----------------------------------------------------------------------------#
+'''
+Habitats.bird_count and Regions.habitat_count are kept by adding the rows a
+flush links or unlinks (bird_count = bird_count + n), so concurrent writes
+add up. Regions.bird_count counts distinct birds and cannot be added to, the
+regions a flush touches are locked (SELECT ... FOR UPDATE) and then recounted,
+which makes concurrent recounts of a region wait for each other's commit.
+Core inserts (bulk.py) call add_counts and recount_region_birds themselves,
+"flask rebuild-counts" recounts them all.
+'''
+
+
+def add_counts(connection, habitat_deltas=None, region_deltas=None):
+    '''
+    add_counts(connection, habitat_deltas, region_deltas) adds the {id: n}
+    deltas to Habitats.bird_count and Regions.habitat_count
+    '''
+    for table, column, deltas in [
+            (Habitat.__table__, 'bird_count', habitat_deltas),
+            (Region.__table__, 'habitat_count', region_deltas)]:
+        values = [{'row_id': row_id, 'delta': delta}
+                  for row_id, delta in sorted((deltas or {}).items())
+                  if delta]
+        if values:
+            connection.execute(
+                update(table)
+                .where(table.c.id == bindparam('row_id'))
+                .values({column: table.c[column] + bindparam('delta')}),
+                values)
+
+
+def recount_region_birds(connection, habitat_ids=(), region_ids=()):
+    '''
+    recount_region_birds(connection, habitat_ids, region_ids) locks the
+    regions given and those of the habitats, then recounts their birds
+    '''
+    habitats, regions = Habitat.__table__, Region.__table__
+    if not habitat_ids and not region_ids:
+        return
+    # locked in id order, so two recounts cannot deadlock
+    locked = connection.scalars(
+        select(regions.c.id)
+        .where(regions.c.id.in_(sorted(region_ids)) | regions.c.id.in_(
+            select(habitats.c.region_id)
+            .where(habitats.c.id.in_(sorted(habitat_ids)))))
+        .order_by(regions.c.id)
+        .with_for_update()).all()
+    if locked:
+        connection.execute(
+            update(regions)
+            .where(regions.c.id.in_(locked))
+            .values(bird_count=region_birds_count()))
+
+
+def region_birds_count():
+    region_habitats = Habitat.__table__.alias('region_habitats')
+    return (select(func.count(range.c.bird_id.distinct()))
+            .select_from(range.join(
+                region_habitats, region_habitats.c.id == range.c.habitat_id))
+            .where(region_habitats.c.region_id == Region.__table__.c.id)
+            .scalar_subquery())
+
+
+def refresh_counts(connection):
+    '''refresh_counts(connection) recounts every habitat and region'''
+    habitats, regions = Habitat.__table__, Region.__table__
+    region_habitats = habitats.alias('region_habitats')
+    connection.execute(update(habitats).values(bird_count=(
+        select(func.count())
+        .where(range.c.habitat_id == habitats.c.id)
+        .scalar_subquery())))
+    connection.execute(update(regions).values(
+        habitat_count=(
+            select(func.count())
+            .where(region_habitats.c.region_id == regions.c.id)
+            .scalar_subquery()),
+        bird_count=region_birds_count()))
+
+
+def _collection_history(instance, attribute):
+    history = inspect(instance).attrs[attribute].history
+    return history.added or (), history.deleted or ()
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def collect_counts(session, flush_context, instances):
+    '''remembers the links and regions whose counts the flush changes'''
+    # (bird, habitat) objects, they may be new and have no id yet
+    linked = session.info.setdefault('count_linked', set())
+    # (bird id, habitat id) of the range rows the flush deletes
+    unlinked = session.info.setdefault('count_unlinked', set())
+    new_habitats = session.info.setdefault('count_habitat_new', [])
+    region_deltas = session.info.setdefault('count_region_deltas', Counter())
+    region_ids = session.info.setdefault('count_region_ids', set())
+    deleted_bird_ids = set()
+
+    for instance in session.new:
+        if isinstance(instance, Bird):
+            linked.update((instance, habitat) for habitat in instance.habitats)
+        elif isinstance(instance, Habitat):
+            new_habitats.append(instance)
+            linked.update((bird, instance) for bird in instance.Birds)
+    for instance in session.dirty:
+        if isinstance(instance, Bird) and _changed(instance, 'habitats'):
+            added, deleted = _collection_history(instance, 'habitats')
+            linked.update((instance, habitat) for habitat in added)
+            unlinked.update((instance.id, habitat.id) for habitat in deleted)
+        elif isinstance(instance, Habitat):
+            if _changed(instance, 'Birds'):
+                added, deleted = _collection_history(instance, 'Birds')
+                linked.update((bird, instance) for bird in added)
+                unlinked.update((bird.id, instance.id) for bird in deleted)
+            if _changed(instance, 'region_id'):
+                # it moves with its birds from one region to the other
+                added, deleted = _collection_history(instance, 'region_id')
+                region_deltas.update(added)
+                region_deltas.subtract(deleted)
+                region_ids.update(added)
+                region_ids.update(deleted)
+    for instance in session.deleted:
+        if isinstance(instance, Bird):
+            deleted_bird_ids.add(instance.id)
+        elif isinstance(instance, Habitat):
+            region_deltas.subtract([instance.region_id])
+            region_ids.add(instance.region_id)
+
+    # the links of a deleted bird are read from range before the flush
+    # deletes them, the rows of a deleted habitat need no count
+    deleted_bird_ids.discard(None)
+    if deleted_bird_ids:
+        unlinked.update(session.connection().execute(
+            select(range.c.bird_id, range.c.habitat_id)
+            .where(range.c.bird_id.in_(deleted_bird_ids))).tuples())
+    linked.difference_update([
+        (bird, habitat) for bird, habitat in linked
+        if bird in session.deleted or habitat in session.deleted])
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def refresh_flushed_counts(session, flush_context):
+    linked = session.info.pop('count_linked', set())
+    unlinked = session.info.pop('count_unlinked', set())
+    region_deltas = session.info.pop('count_region_deltas', Counter())
+    region_deltas.update(habitat.region_id for habitat in
+                         session.info.pop('count_habitat_new', []))
+    region_ids = session.info.pop('count_region_ids', set())
+
+    habitat_deltas = Counter(habitat.id for _, habitat in linked)
+    habitat_deltas.subtract(habitat_id for _, habitat_id in unlinked)
+    region_deltas.pop(None, None)
+    region_ids.discard(None)
+    connection = session.connection()
+    add_counts(connection, habitat_deltas, region_deltas)
+    recount_region_birds(connection, set(habitat_deltas), region_ids)
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def forget_counts(session, previous_transaction):
+    for key in ['count_linked', 'count_unlinked', 'count_habitat_new',
+                'count_region_deltas', 'count_region_ids']:
+        session.info.pop(key, None)
@@ -0,0 +1,244 @@
+from flask import abort
+from sqlalchemy.exc import IntegrityError
+from models import db, Region, Habitat, Bird, bump_version, reference_rows
+
+
+'''
+Writes on birds and habitats shared by the endpoints and /batch. They
+validate the body (aborting with the same errors as the endpoints), change
+and flush the session but never commit, and return the changed resource
+with the paths of the cached responses it affects.
+'''
+
+
+def flush_or_abort(message=None):
+    '''flush_or_abort(message) flushes, a constraint violation is a 422'''
+    try:
+        db.session.flush()
+    except IntegrityError:
+        abort(422, message)
+
+
+def get_or_404(model, resource_id):
+    resource = model.query.filter(model.id == resource_id).one_or_none()
+    # Resource not found
+    if resource is None:
+        abort(404)
+    return resource
+
+
+def get_habitats_or_404(habitats):
+    cached = reference_rows('Habitats')
+    # ids sent as strings are left to the database to compare
+    if cached is not None and all(isinstance(habitat_id, int)
+                                  for habitat_id in habitats):
+        found = {habitat_id for habitat_id in habitats if habitat_id in cached}
+        # one of the habitats provided doesnt match the habitats in the db abort
+        if len(found) != len(habitats):
+            abort(404)
+        # the cached rows only vouch for the ids, the habitats are loaded
+        # in one query so no stale or partial row is used
+        get_habitats = Habitat.query.filter(
+            Habitat.id.in_(found)).order_by(Habitat.id).all()
+        # deleted since the cached version was read
+        if len(get_habitats) != len(found):
+            abort(404)
+        return get_habitats
+
+    get_habitats = Habitat.query.filter(Habitat.id.in_(habitats)).all()
+    # one of the habitats provided doesnt match the habitats in the db abort
+    if len(get_habitats) != len(habitats):
+        abort(404)
+    return get_habitats
+
+
+def region_exists(region_id):
+    cached = reference_rows('Regions')
+    if cached is not None:
+        return region_id in cached
+    return Region.query.filter(Region.id == region_id).one_or_none() is not None
+
+
+def region_id_or_400(region_id):
+    '''region_id_or_400(region_id) is the int id of an existing region'''
+    # digit strings are ids too, as when the database compared them
+    if isinstance(region_id, str) and region_id.strip().isdigit():
+        region_id = int(region_id)
+    # if invalid region is given abort
+    if (isinstance(region_id, bool) or not isinstance(region_id, int) or
+            not region_exists(region_id)):
+        abort(400)
+    return region_id
+
+
+def habitat_response_paths(habitat):
+    '''paths of the cached responses that show the habitat'''
+    return ['/habitats', f'/habitats/{habitat.id}', '/birds'] + [
+        f'/birds/{bird.id}' for bird in habitat.Birds]
+
+
+# ----------------------------------------------------------------------------#
+# Birds.
+# ----------------------------------------------------------------------------#
+
+
+def create_bird(body):
+    common_name = body.get('common_name', None)
+    species = body.get('species', None)
+    habitats = body.get('habitats', None)
+    image_link = body.get('image_link', '')
+
+    # if required attributes are not submitted abort
+    if None in [common_name, species, habitats] or len(habitats) == 0:
+        abort(400)
+
+    new_bird = Bird(common_name, species, image_link)
+    new_bird.habitats = get_habitats_or_404(habitats)
+    db.session.add(new_bird)
+    flush_or_abort('duplicate bird resource')
+    bump_version(Bird.__tablename__)
+    return new_bird, ['/birds']
+
+
+def patch_bird(bird_id, body):
+    edit_bird = get_or_404(Bird, bird_id)
+
+    habitats = body.get('habitats', None)
+    changes = {att: body.get(att) for att in
+               ['common_name', 'species', 'image_link'] if body.get(att)}
+
+    # the unique name is checked before anything is changed
+    common_name = changes.get('common_name')
+    if common_name and Bird.query.filter(
+            Bird.common_name == common_name,
+            Bird.id != bird_id).first() is not None:
+        abort(422, 'Bird common_name already exist')
+
+    if habitats is not None:
+        edit_bird.habitats = get_habitats_or_404(habitats)
+    for att, attribute in changes.items():
+        setattr(edit_bird, att, attribute)
+
+    flush_or_abort('Bird common_name already exist')
+    bump_version(Bird.__tablename__)
+    return edit_bird, ['/birds', f'/birds/{bird_id}']
+
+
+def delete_bird(bird_id):
+    bird = get_or_404(Bird, bird_id)
+    db.session.delete(bird)
+    flush_or_abort()
+    bump_version(Bird.__tablename__)
+    return bird, ['/birds', f'/birds/{bird_id}']
+
+
+# ----------------------------------------------------------------------------#
+# Habitats.
+# ----------------------------------------------------------------------------#
+
+
+def create_habitat(body):
+    name = body.get('name', None)
+    region_id = body.get('region_id', None)
+    habitat_bird = body.get('bird', None)
+
+    # if required attributes are not submitted abort
+    if None in [name, region_id]:
+        abort(400)
+
+    region_id = region_id_or_400(region_id)
+
+    new_habitat = Habitat(name=name, region_id=region_id)
+    paths = ['/habitats']
+
+    if habitat_bird:
+        update_bird = Bird.query.filter(
+            Bird.id == habitat_bird).one_or_none()
+        if update_bird is None:
+            abort(400)
+        new_habitat.Birds.append(update_bird)
+        paths += ['/birds', f'/birds/{habitat_bird}']
+
+    db.session.add(new_habitat)
+    flush_or_abort('Habitat resource already exist')
+    bump_version(Habitat.__tablename__)
+    return new_habitat, paths
+
+
+def patch_habitat(habitat_id, body):
+    edit_habitat = get_or_404(Habitat, habitat_id)
+    paths = habitat_response_paths(edit_habitat)
+
+    name = body.get('name', None)
+    region_id = body.get('region_id', None)
+
+    # the unique name is checked before anything is changed
+    if name and Habitat.query.filter(
+            Habitat.name == name,
+            Habitat.id != habitat_id).first() is not None:
+        abort(422, 'Habitat name already exist')
+
+    if region_id:
+        edit_habitat.region_id = region_id_or_400(region_id)
+    if name:
+        edit_habitat.name = name
+
+    flush_or_abort('Habitat name already exist')
+    bump_version(Habitat.__tablename__)
+    return edit_habitat, paths
+
+
+def delete_habitat(habitat_id):
+    habitat = get_or_404(Habitat, habitat_id)
+    paths = habitat_response_paths(habitat)
+    db.session.delete(habitat)
+    flush_or_abort()
+    bump_version(Habitat.__tablename__)
+    return habitat, paths
+
+
+# ----------------------------------------------------------------------------#
+# Batch.
+# ----------------------------------------------------------------------------#
+'''(op, resource) -> (permission, operation, takes an id, takes a body)'''
+OPERATIONS = {
+    ('create', 'birds'): ('post:birds', create_bird, False, True),
+    ('patch', 'birds'): ('patch:birds', patch_bird, True, True),
+    ('delete', 'birds'): ('delete:birds', delete_bird, True, False),
+    ('create', 'habitats'): ('post:habitats', create_habitat, False, True),
+    ('patch', 'habitats'): ('patch:habitats', patch_habitat, True, True),
+    ('delete', 'habitats'): ('delete:habitats', delete_habitat, True, False),
+}
+
+
+def validate_batch(operations):
+    '''
+    validate_batch(operations) aborts with 400 on a malformed operation and
+    returns the permissions the batch needs
+    '''
+    permissions = set()
+    for operation in operations:
+        if not isinstance(operation, dict):
+            abort(400)
+        key = (operation.get('op'), operation.get('resource'))
+        if key not in OPERATIONS:
+            abort(400)
+        permission, _, takes_id, takes_body = OPERATIONS[key]
+        if takes_id and not isinstance(operation.get('id'), int):
+            abort(400)
+        if takes_body and not isinstance(operation.get('data'), dict):
+            abort(400)
+        permissions.add(permission)
+    return permissions
+
+
+def run_operation(operation):
+    '''run_operation(operation) runs one validated batch operation'''
+    _, function, takes_id, takes_body = OPERATIONS[
+        (operation['op'], operation['resource'])]
+    arguments = []
+    if takes_id:
+        arguments.append(operation['id'])
+    if takes_body:
+        arguments.append(operation['data'])
+    return function(*arguments)
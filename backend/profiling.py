@@ -0,0 +1,241 @@
+import cProfile
+import glob
+import hmac
+import logging
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from flask import g, request
+from sqlalchemy import event
+
+
+PROFILING_ENABLED = os.environ.get(
+    'PROFILING_ENABLED', 'false').lower() in ('true', '1')
+PROFILE_HEADER = 'X-Profile'
+# the X-Profile header must carry it, no request is profiled without it
+PROFILE_SECRET = os.environ.get('PROFILE_SECRET', '')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', tempfile.gettempdir())
+# the dumps kept in PROFILE_DIR, the oldest are removed
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 20))
+PROFILE_PREFIX = 'botw-profile-'
+# upper bounds in milliseconds of the latency histogram buckets
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+# the timings of the request being profiled, None outside of one
+request_timings = ContextVar('request_timings', default=None)
+
+logger = logging.getLogger(__name__)
+
+
+def add_timing(name, seconds):
+    timings = request_timings.get()
+    if timings is not None:
+        total, count = timings.get(name, (0.0, 0))
+        timings[name] = (total + seconds, count + 1)
+
+
+@contextmanager
+def timer(name):
+    '''timer(name) adds the time spent in the block to the request timings'''
+    if request_timings.get() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(name, time.perf_counter() - start)
+
+
+def timed(name):
+    '''timed(name) adds the time spent in the function to the request timings'''
+    def timed_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            # a single lookup when profiling is off, format() runs per item
+            if request_timings.get() is None:
+                return f(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                add_timing(name, time.perf_counter() - start)
+        return wrapper
+    return timed_decorator
+
+
+def server_timing(timings, total):
+    '''server_timing(timings, total) is the Server-Timing header of a request'''
+    metrics = []
+    for name, (seconds, count) in timings.items():
+        metric = f'{name};dur={seconds * 1000:.2f}'
+        if count > 1:
+            metric += f';desc="{count}x"'
+        metrics.append(metric)
+    metrics.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(metrics)
+
+
+class RouteHistograms:
+    '''
+    RouteHistograms
+    Latency histogram (LATENCY_BUCKETS) and query count of every route,
+    keyed by method and url rule so /birds/1 and /birds/2 add up.
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def observe(self, route, seconds, queries):
+        milliseconds = seconds * 1000
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = {
+                    'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'queries': 0,
+                    'buckets': [0] * (len(self.buckets) + 1)}
+            stats['count'] += 1
+            stats['total_ms'] += milliseconds
+            stats['max_ms'] = max(stats['max_ms'], milliseconds)
+            stats['queries'] += queries
+            stats['buckets'][bisect_left(self.buckets, milliseconds)] += 1
+
+    def stats(self):
+        labels = [f'le_{bound}' for bound in self.buckets] + ['le_inf']
+        with self._lock:
+            return {
+                route: {
+                    'count': stats['count'],
+                    'avg_ms': round(stats['total_ms'] / stats['count'], 3),
+                    'max_ms': round(stats['max_ms'], 3),
+                    'queries_per_request': round(
+                        stats['queries'] / stats['count'], 2),
+                    # cumulative, like a prometheus histogram
+                    'buckets': dict(zip(labels, _cumulative(stats['buckets'])))}
+                for route, stats in sorted(self._routes.items())}
+
+
+def _cumulative(counts):
+    total = 0
+    for count in counts:
+        total += count
+        yield total
+
+
+# ----------------------------------------------------------------------------#
+# Setup
+# ----------------------------------------------------------------------------#
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if request_timings.get() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    starts = conn.info.get('query_start')
+    if request_timings.get() is not None and starts:
+        add_timing('db', time.perf_counter() - starts.pop())
+
+
+def profile_requested():
+    '''profile_requested() tells whether the X-Profile header has the secret'''
+    secret = request.headers.get(PROFILE_HEADER)
+    return bool(PROFILE_SECRET and secret and hmac.compare_digest(
+        secret.encode(), PROFILE_SECRET.encode()))
+
+
+def profile_path(start):
+    endpoint = request.endpoint or 'unknown'
+    return os.path.join(PROFILE_DIR, f'{PROFILE_PREFIX}{endpoint}-'
+                                     f'{int(start * 1000)}-{os.getpid()}.prof')
+
+
+def rotate_profiles(max_files=None):
+    '''rotate_profiles(max_files) removes the oldest dumps beyond max_files'''
+    max_files = PROFILE_MAX_FILES if max_files is None else max_files
+    paths = glob.glob(os.path.join(
+        glob.escape(PROFILE_DIR), f'{PROFILE_PREFIX}*.prof'))
+    if len(paths) <= max_files:
+        return
+    paths.sort(key=profile_mtime)
+    for path in paths[:len(paths) - max_files]:
+        try:
+            os.remove(path)
+        except OSError:
+            # removed by another worker
+            pass
+
+
+def profile_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def setup_profiling(app, engines):
+    '''
+    setup_profiling(app, engines) times every request of the app and the
+    queries on the engines: a Server-Timing header on each response, route
+    histograms for /metrics, and a cProfile dump (in PROFILE_DIR, at most
+    PROFILE_MAX_FILES) of the requests whose X-Profile header is
+    PROFILE_SECRET.
+    '''
+    histograms = RouteHistograms()
+    app.extensions['route_histograms'] = histograms
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    @app.before_request
+    def start_profiling():
+        g.profiling_start = time.perf_counter()
+        g.profiling_token = request_timings.set({})
+        if profile_requested():
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    # registered before the other after_request handlers so it runs last and
+    # times them too
+    @app.after_request
+    def finish_profiling(response):
+        timings = request_timings.get()
+        if timings is None or 'profiling_start' not in g:
+            return response
+        total = time.perf_counter() - g.profiling_start
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            path = profile_path(g.profiling_start)
+            profiler.dump_stats(path)
+            rotate_profiles()
+            # the path is logged, not shown to the client
+            logger.info('profile of %s %s written to %s', request.method,
+                        request.path, path)
+
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        queries = timings.get('db', (0.0, 0))[1]
+        histograms.observe(f'{request.method} {rule}', total, queries)
+        response.headers['Server-Timing'] = server_timing(timings, total)
+        return response
+
+    @app.teardown_request
+    def stop_profiling(exc):
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+        token = g.pop('profiling_token', None)
+        if token is not None:
+            request_timings.reset(token)
+
+    return histograms
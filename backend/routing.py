@@ -0,0 +1,230 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, g, has_app_context, request
+from flask_sqlalchemy.session import Session
+
+
+DATABASE_REPLICA_STRATEGY = os.environ.get(
+    'DATABASE_REPLICA_STRATEGY', 'round_robin')
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# redis shared by the workers to remember who wrote, the response cache's
+# by default; without it each worker remembers its own writes
+REPLICA_STICKY_URL = os.environ.get(
+    'REPLICA_STICKY_URL', os.environ.get('RESPONSE_CACHE_URL', None))
+REPLICA_BIND_PREFIX = 'replica_'
+WRITE_METHODS = ('POST', 'PATCH', 'DELETE')
+# unix time of the client's last write, sent back by the client
+LAST_WRITE_HEADER = 'X-Last-Write'
+
+
+class RoutingSession(Session):
+    '''
+    RoutingSession
+    Sends the queries of a request marked by read_replica to the replica
+    engine chosen for it. Flushes always go to the primary.
+    '''
+
+    def __init__(self, db, **kwargs):
+        connection = (current_app.extensions.get('session_connection')
+                      if has_app_context() else None)
+        if connection is not None:
+            # the app runs in rollback_transaction, commits become savepoints
+            kwargs.update(bind=connection,
+                          join_transaction_mode='create_savepoint')
+        super().__init__(db, **kwargs)
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and has_app_context() and
+                g.get('read_bind') is not None):
+            return self._db.engines[g.read_bind]
+        # a session joined to an outside connection (rollback_transaction)
+        if bind is None and self.bind is not None:
+            return self.bind
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+# ----------------------------------------------------------------------------#
+# Write logs
+# ----------------------------------------------------------------------------#
+'''
+A write log remembers the subjects that wrote in the last seconds:
+record(subject, seconds) and recent(subject).
+'''
+
+
+class MemoryWriteLog:
+    '''MemoryWriteLog keeps the writes of one worker in memory'''
+
+    def __init__(self):
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def record(self, subject, seconds):
+        now = time.monotonic()
+        with self._lock:
+            self._expires[subject] = now + seconds
+            for other, expires in list(self._expires.items()):
+                if expires <= now:
+                    del self._expires[other]
+
+    def recent(self, subject):
+        with self._lock:
+            expires = self._expires.get(subject)
+        return expires is not None and time.monotonic() < expires
+
+
+class RedisWriteLog:
+    '''
+    RedisWriteLog
+    Keeps the writes in redis keys that expire with the window, so every
+    worker sees them. Any client with set(px=) and exists works.
+    '''
+
+    def __init__(self, client, prefix='botw:write:'):
+        self.client = client
+        self.prefix = prefix
+
+    def record(self, subject, seconds):
+        self.client.set(self.prefix + subject, 1,
+                        px=max(int(seconds * 1000), 1))
+
+    def recent(self, subject):
+        return bool(self.client.exists(self.prefix + subject))
+
+
+class ReplicaRouter:
+    '''
+    ReplicaRouter
+    Picks the replica of a read, round robin or the one serving the fewest
+    reads (least_load), and remembers (in write_log) the subjects that wrote
+    in the last sticky_seconds so they read their own writes from the
+    primary.
+    '''
+
+    def __init__(self, bind_keys, strategy=DATABASE_REPLICA_STRATEGY,
+                 sticky_seconds=REPLICA_STICKY_SECONDS, write_log=None):
+        if strategy not in ('round_robin', 'least_load'):
+            raise ValueError(f'unknown replica strategy {strategy}')
+        self.bind_keys = list(bind_keys)
+        self.strategy = strategy
+        self.sticky_seconds = sticky_seconds
+        self.write_log = write_log if write_log is not None else MemoryWriteLog()
+        self._turn = 0
+        self._load = {key: 0 for key in self.bind_keys}
+        self._lock = threading.Lock()
+
+    def choose(self):
+        with self._lock:
+            # the round robin turn also breaks the ties of least_load
+            start = self._turn % len(self.bind_keys)
+            self._turn += 1
+            keys = self.bind_keys[start:] + self.bind_keys[:start]
+            if self.strategy == 'least_load':
+                key = min(keys, key=lambda key: self._load[key])
+            else:
+                key = keys[0]
+            self._load[key] += 1
+            return key
+
+    def release(self, key):
+        with self._lock:
+            self._load[key] -= 1
+
+    def record_write(self, subject):
+        if subject is not None and self.sticky_seconds > 0:
+            self.write_log.record(subject, self.sticky_seconds)
+
+    def sticky(self, subject, last_write=None):
+        '''
+        sticky(subject, last_write) tells whether a read goes to the primary:
+        the client wrote at last_write (unix time), or the subject wrote,
+        within sticky_seconds
+        '''
+        if (last_write is not None and
+                time.time() - last_write < self.sticky_seconds):
+            return True
+        return subject is not None and self.sticky_seconds > 0 and (
+            self.write_log.recent(subject))
+
+
+def replica_binds(replica_paths):
+    '''replica_binds(replica_paths) are the SQLALCHEMY_BINDS of the replicas'''
+    return {f'{REPLICA_BIND_PREFIX}{number}': path
+            for number, path in enumerate(replica_paths)}
+
+
+def setup_routing(app):
+    '''setup_routing(app) routes reads to the replica binds of the app, if any'''
+    bind_keys = [key for key in app.config.get('SQLALCHEMY_BINDS', {})
+                 if key.startswith(REPLICA_BIND_PREFIX)]
+    if not bind_keys:
+        return None
+    write_log = None
+    if REPLICA_STICKY_URL:
+        import redis
+        write_log = RedisWriteLog(redis.Redis.from_url(REPLICA_STICKY_URL))
+    router = ReplicaRouter(bind_keys, write_log=write_log)
+    app.extensions['replica_router'] = router
+    return router
+
+
+# ----------------------------------------------------------------------------#
+# Requests
+# ----------------------------------------------------------------------------#
+
+
+def last_write():
+    '''last_write() is the LAST_WRITE_HEADER of the request, None if invalid'''
+    try:
+        return float(request.headers[LAST_WRITE_HEADER])
+    except (KeyError, ValueError):
+        return None
+
+
+@contextmanager
+def read_replica(payload):
+    '''
+    read_replica(payload) runs the queries of the block on a replica, unless
+    the subject of the payload, or the client, wrote within the sticky window
+    '''
+    g.read_only = True
+    router = current_app.extensions.get('replica_router')
+    if router is None or router.sticky(payload.get('sub'), last_write()):
+        yield None
+        return
+
+    key = router.choose()
+    g.read_bind = key
+    try:
+        yield key
+    finally:
+        g.read_bind = None
+        router.release(key)
+
+
+def read_only(f):
+    '''read_only reads a handler from a replica, goes below requires_auth'''
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        with read_replica(payload):
+            return f(payload, *args, **kwargs)
+    return wrapper
+
+
+def record_write(response):
+    '''
+    record_write(response) starts the sticky window after a write, in the
+    write log and in the LAST_WRITE_HEADER the client sends back
+    '''
+    router = current_app.extensions.get('replica_router')
+    payload = g.get('auth_payload')
+    if (router is not None and payload is not None and
+            request.method in WRITE_METHODS and
+            response.status_code < 400 and not g.get('read_only')):
+        router.record_write(payload.get('sub'))
+        response.headers[LAST_WRITE_HEADER] = f'{time.time():.3f}'
+    return response
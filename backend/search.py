@@ -0,0 +1,182 @@
+import os
+import re
+import threading
+from flask import current_app
+from sqlalchemy import select, func, literal, or_, union_all
+from models import db, Bird, Habitat, get_versions
+
+
+# pg_trgm's default similarity_threshold, used by the pg_trgm search and the
+# in-memory index
+SEARCH_SIMILARITY_THRESHOLD = float(
+    os.environ.get('SEARCH_SIMILARITY_THRESHOLD', 0.3))
+SEARCH_KINDS = ('birds', 'habitats')
+
+
+def trigrams(text):
+    '''trigrams(text) returns the pg_trgm style trigrams of the words in text'''
+    grams = set()
+    for word in re.findall(r'\w+', text.lower()):
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(grams, other_grams):
+    '''similarity(grams, other_grams) is the share of trigrams in common'''
+    if not grams or not other_grams:
+        return 0.0
+    return len(grams & other_grams) / len(grams | other_grams)
+
+
+def escape_like(term):
+    return re.sub(r'([!%_])', r'!\1', term)
+
+
+# ----------------------------------------------------------------------------#
+# In-memory n-gram index
+# ----------------------------------------------------------------------------#
+
+
+class NgramIndex:
+    '''
+    NgramIndex
+    In-memory trigram index of the bird and habitat names, used instead of
+    pg_trgm on databases without it (SQLite). Matches and ranks the same
+    way: a case insensitive substring match or a trigram similarity above
+    the threshold, ordered by similarity.
+    '''
+
+    def __init__(self, version=None):
+        self.version = version
+        self._documents = []
+        self._postings = {}
+
+    def add(self, kind, id, name, *fields):
+        position = len(self._documents)
+        texts = [field.lower() for field in fields if field]
+        field_grams = [trigrams(text) for text in texts]
+        self._documents.append((kind, id, name, texts, field_grams))
+        for gram in set().union(*field_grams):
+            self._postings.setdefault(gram, set()).add(position)
+
+    def search(self, term, kinds=SEARCH_KINDS):
+        needle = term.lower()
+        term_grams = trigrams(term)
+        # a short term can be a substring of any name, so scan them all
+        if len(needle.strip()) < 3 or not term_grams:
+            candidates = range(len(self._documents))
+        else:
+            candidates = set().union(
+                *(self._postings.get(gram, ()) for gram in term_grams))
+
+        results = []
+        for position in candidates:
+            kind, id, name, texts, field_grams = self._documents[position]
+            if kind not in kinds:
+                continue
+            score = max(similarity(term_grams, grams) for grams in field_grams)
+            if (score >= SEARCH_SIMILARITY_THRESHOLD or
+                    any(needle in text for text in texts)):
+                results.append(format_result(kind, id, name, score))
+        results.sort(key=lambda item: (-item['score'], item['type'],
+                                       item['id']))
+        return results
+
+
+_index_lock = threading.Lock()
+
+
+def build_search_index(version=None):
+    index = NgramIndex(version)
+    for row in db.session.execute(
+            select(Habitat.id, Habitat.name).order_by(Habitat.id)):
+        index.add('habitats', row.id, row.name, row.name)
+    for row in db.session.execute(
+            select(Bird.id, Bird.common_name, Bird.species).order_by(Bird.id)):
+        index.add('birds', row.id, row.common_name, row.common_name,
+                  row.species)
+    return index
+
+
+def get_search_index():
+    '''get_search_index() returns the index, rebuilt when the tables change'''
+    versions = get_versions('Birds', 'Habitats')
+    version = tuple(version for version, _ in versions.values())
+    index = current_app.extensions.get('search_index')
+    if index is None or index.version != version:
+        with _index_lock:
+            index = current_app.extensions.get('search_index')
+            if index is None or index.version != version:
+                index = build_search_index(version)
+                current_app.extensions['search_index'] = index
+    return index
+
+
+# ----------------------------------------------------------------------------#
+# Search
+# ----------------------------------------------------------------------------#
+
+
+def format_result(kind, id, name, score):
+    return {
+        'type': kind[:-1],
+        'id': id,
+        'name': name,
+        'score': round(score, 4)}
+
+
+def _trigram_search(term, kinds, limit, offset):
+    '''ranked search on the pg_trgm GIN indexes'''
+    pattern = '%' + escape_like(term) + '%'
+    selects = []
+    if 'habitats' in kinds:
+        selects.append(
+            select(literal('habitats').label('kind'),
+                   Habitat.id.label('id'),
+                   Habitat.name.label('name'),
+                   func.similarity(Habitat.name, term).label('score'))
+            .where(or_(Habitat.name.ilike(pattern, escape='!'),
+                       Habitat.name.op('%')(term))))
+    if 'birds' in kinds:
+        selects.append(
+            select(literal('birds').label('kind'),
+                   Bird.id.label('id'),
+                   Bird.common_name.label('name'),
+                   func.greatest(func.similarity(Bird.common_name, term),
+                                 func.similarity(Bird.species, term))
+                   .label('score'))
+            .where(or_(Bird.common_name.ilike(pattern, escape='!'),
+                       Bird.species.ilike(pattern, escape='!'),
+                       Bird.common_name.op('%')(term),
+                       Bird.species.op('%')(term))))
+
+    matches = (union_all(*selects) if len(selects) > 1
+               else selects[0]).subquery()
+    # % compares with pg_trgm.similarity_threshold, set it for this
+    # transaction only (SET LOCAL) so the GIN indexes are still used
+    db.session.execute(select(func.set_config(
+        'pg_trgm.similarity_threshold', str(SEARCH_SIMILARITY_THRESHOLD),
+        True)))
+    total = db.session.execute(
+        select(func.count()).select_from(matches)).scalar()
+    rows = db.session.execute(
+        select(matches)
+        .order_by(matches.c.score.desc(), matches.c.kind, matches.c.id)
+        .limit(limit).offset(offset)).all()
+    results = [format_result(row.kind, row.id, row.name, row.score)
+               for row in rows]
+    return results, total
+
+
+def search_names(term, kinds=SEARCH_KINDS, limit=None, offset=0):
+    '''
+    search_names(term, kinds, limit, offset) returns a page of ranked
+    {type, id, name, score} results and the total number of matches
+    '''
+    if db.engine.dialect.name == 'postgresql':
+        return _trigram_search(term, kinds, limit, offset)
+
+    results = get_search_index().search(term, kinds)
+    end = None if limit is None else offset + limit
+    return results[offset:end], len(results)
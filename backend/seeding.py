@@ -0,0 +1,160 @@
+import os
+import sqlite3
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from models import db, test_db
+from populate import populate_region, populate_habitats, populate_birds
+
+
+'''
+Seeds the test databases. The first create_app(test_config) of a process
+creates and populates the database and snapshots it, the next ones restore
+the snapshot instead of dropping, recreating and populating the tables:
+
+- SQLite: the database file is copied into memory with the backup API and
+  copied back, which is safe with other connections open on the file.
+- Postgres: the tables are copied into the SNAPSHOT_SCHEMA of the same
+  database and restored with TRUNCATE + INSERT ... SELECT in one
+  transaction. Unlike a template database this needs no CREATEDB and does
+  not drop the database under open connections.
+
+isolated_database_url gives each parallel test process (pytest-xdist's
+PYTEST_XDIST_WORKER, or TEST_WORKER) its own database.
+'''
+
+SNAPSHOT_SCHEMA = 'botw_snapshot'
+
+# database url -> snapshot of the seeded database, one per process
+_snapshots = {}
+
+
+def populate_db():
+    populate_region()
+    populate_habitats()
+    populate_birds()
+
+
+def seed_test_db(app):
+    '''seed_test_db(app) gives the database of app the populated test data'''
+    url = app.config['SQLALCHEMY_DATABASE_URI']
+    with app.app_context():
+        snapshot = _snapshots.get(url)
+        if snapshot is not None:
+            snapshot.restore(db.engine)
+            return
+        test_db(app)
+        populate_db()
+        db.session.remove()
+        if db.engine.dialect.name == 'sqlite':
+            snapshot = SQLiteSnapshot(db.engine)
+        elif db.engine.dialect.name == 'postgresql':
+            snapshot = PostgresSnapshot(db.engine)
+        else:
+            return
+        _snapshots[url] = snapshot
+
+
+class SQLiteSnapshot:
+    '''
+    SQLiteSnapshot
+    In-memory copy of a SQLite database file, schema and sequences included.
+    '''
+
+    def __init__(self, engine):
+        self.memory = sqlite3.connect(':memory:', check_same_thread=False)
+        with sqlite3.connect(engine.url.database) as source:
+            source.backup(self.memory)
+
+    def restore(self, engine):
+        # pooled connections would otherwise keep their prepared statements
+        engine.dispose()
+        target = sqlite3.connect(engine.url.database)
+        try:
+            self.memory.backup(target)
+        finally:
+            target.close()
+
+
+class PostgresSnapshot:
+    '''
+    PostgresSnapshot
+    Copy of the seeded tables in SNAPSHOT_SCHEMA of the same database.
+    '''
+
+    def __init__(self, engine):
+        self.tables = [table.name for table in db.metadata.sorted_tables]
+        with engine.begin() as connection:
+            connection.execute(text(
+                f'DROP SCHEMA IF EXISTS {SNAPSHOT_SCHEMA} CASCADE'))
+            connection.execute(text(f'CREATE SCHEMA {SNAPSHOT_SCHEMA}'))
+            for table in self.tables:
+                connection.execute(text(
+                    f'CREATE TABLE {SNAPSHOT_SCHEMA}."{table}" '
+                    f'AS TABLE public."{table}"'))
+
+    def restore(self, engine):
+        with engine.begin() as connection:
+            tables = ', '.join(f'public."{table}"' for table in self.tables)
+            connection.execute(text(
+                f'TRUNCATE {tables} RESTART IDENTITY CASCADE'))
+            for table in self.tables:
+                connection.execute(text(
+                    f'INSERT INTO public."{table}" '
+                    f'SELECT * FROM {SNAPSHOT_SCHEMA}."{table}"'))
+            # the ids were inserted explicitly, move the serials past them
+            for table in db.metadata.sorted_tables:
+                column = table.autoincrement_column
+                if column is None:
+                    continue
+                connection.execute(text(
+                    f'SELECT setval(pg_get_serial_sequence('
+                    f"'public.\"{table.name}\"', '{column.name}'), "
+                    f'COALESCE(MAX("{column.name}"), 0) + 1, false) '
+                    f'FROM public."{table.name}"'))
+
+
+# ----------------------------------------------------------------------------#
+# Parallel test processes
+# ----------------------------------------------------------------------------#
+
+
+def worker_id():
+    return os.environ.get('PYTEST_XDIST_WORKER') or os.environ.get(
+        'TEST_WORKER')
+
+
+def isolated_database_url(url, worker=None):
+    '''
+    isolated_database_url(url, worker) is the database of a parallel test
+    worker: testbotw-gw0.db for SQLite, testbotwdb_gw0 on Postgres (created
+    if missing). Without a worker it is url.
+    '''
+    worker = worker or worker_id()
+    if not worker:
+        return url
+    database_url = make_url(url)
+    if database_url.get_backend_name() == 'sqlite':
+        root, extension = os.path.splitext(database_url.database)
+        return database_url.set(
+            database=f'{root}-{worker}{extension}').render_as_string(
+                hide_password=False)
+
+    database = f'{database_url.database}_{worker}'
+    create_database(database_url, database)
+    return database_url.set(database=database).render_as_string(
+        hide_password=False)
+
+
+def create_database(database_url, database):
+    '''create_database(database_url, database) creates a Postgres database'''
+    engine = create_engine(database_url.set(database='postgres'),
+                           isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as connection:
+            exists = connection.scalar(
+                text('SELECT 1 FROM pg_database WHERE datname = :name'),
+                {'name': database})
+            if not exists:
+                connection.execute(text(f'CREATE DATABASE "{database}"'))
+    finally:
+        engine.dispose()
@@ -1,16 +1,45 @@
+import asyncio
+import glob
+import gzip
 import os
+import shutil
+import tempfile
 import unittest
 import json
 from app import create_app
-from models import Bird, Habitat
-from time import time
+from models import db, Bird, Habitat, Region, BirdCard, rollback_transaction
+from seeding import isolated_database_url
+from graph import related_birds_query
+from sqlalchemy import event, create_engine
+from time import time, sleep
+from flask import Flask
 from unittest.mock import patch
-from mock_rsa_keys import create_test_token, mock_get_jwks
+from mock_rsa_keys import create_test_token, mock_get_jwks, JWT_HEADERS
+from auth import JWKSCache, TokenCache, token_cache
+from cache import LRUResponseCache, RedisResponseCache
+from models import pool_options, bump_version, add_missing_columns
+from models import refresh_bird_cards, get_versions
+from routing import ReplicaRouter, MemoryWriteLog, RedisWriteLog
+from asgi import ASGIApplication
+from flask.json.provider import DefaultJSONProvider
+from json_provider import ORJSONProvider
+import compress
+import pstats
+from profiling import RouteHistograms
+from datetime import datetime
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects import postgresql
 
 
 database_path = os.environ['TEST_DATABASE_URL']
 if database_path.startswith('postgres://'):
     database_path = database_path.replace('postgres://', 'postgresql://', 1)
+# every parallel test process gets a database of its own
+database_path = isolated_database_url(database_path)
+
+# true seeds the database once and rolls back every test, false recreates
+# and reseeds it for each test
+TEST_ROLLBACK = os.environ.get('TEST_ROLLBACK', 'true').lower() in ('true', '1')
 
 API_AUDIENCE = os.environ['API_AUDIENCE']
 ALGORITHMS = os.environ['ALGORITHMS']
@@ -34,6 +63,7 @@ owner_token_payload = {
         'delete:habitats',
         'get:birds',
         'get:habitats',
+        'get:metrics',
         'get:regions',
         'patch:birds',
         'patch:habitats',
@@ -67,10 +97,24 @@ headers_viewers = {'HTTP_AUTHORIZATION': f'Bearer {viewer_access_token}'}
 class BirdsOfTWorldsTestCase(unittest.TestCase):
     '''This class represents the birds of the world test case'''
 
+    @classmethod
+    def setUpClass(cls):
+        if TEST_ROLLBACK:
+            cls.seeded_app = create_app(database_path)
+
     def setUp(self):
         '''Define test variables and initialize app.'''
 
-        self.app = create_app(database_path)
+        if TEST_ROLLBACK:
+            self.app = self.rolled_back(self.seeded_app)
+            # the table versions roll back too, so the caches keyed on them
+            # could match again
+            self.app.extensions['response_cache'].clear()
+            self.app.extensions.pop('search_index', None)
+            self.app.extensions.pop('reference_data', None)
+            token_cache.clear()
+        else:
+            self.app = create_app(database_path)
         self.client = self.app.test_client
         self.post_bird_success = {
             'common_name': 'European Robin',
@@ -105,6 +149,14 @@ class BirdsOfTWorldsTestCase(unittest.TestCase):
         '''Executed after reach test'''
         pass
 
+    def rolled_back(self, app):
+        '''runs the test in a transaction of app that the cleanup rolls back'''
+        if TEST_ROLLBACK:
+            transaction = rollback_transaction(app)
+            transaction.__enter__()
+            self.addCleanup(transaction.__exit__, None, None, None)
+        return app
+
     # ----------------------------------------------------------------------------#
     # RBAC Tests
     # ----------------------------------------------------------------------------#
@@ -149,6 +201,90 @@ class BirdsOfTWorldsTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertGreater(data['total_birds'], 1)
 
+    def test_paginated_birds_total_count(self):
+        res = self.client().get(
+            '/birds?page=2&limit=5', environ_base=headers_viewers)
+        data = json.loads(res.data)
+        with self.app.app_context():
+            total_birds = Bird.query.count()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_birds'], total_birds)
+
+    def test_paginated_birds_without_total(self):
+        res = self.client().get(
+            '/birds?page=1&total=false', environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertNotIn('total_birds', data)
+
+    def test_cursor_paginated_birds(self):
+        res = self.client().get(
+            '/birds?limit=5', environ_base=headers_viewers)
+        first_page = json.loads(res.data)
+        res = self.client().get(
+            f'/birds?after={first_page["next_cursor"]}&limit=5',
+            environ_base=headers_viewers)
+        second_page = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(first_page['next_cursor'], 5)
+        self.assertEqual([bird['id'] for bird in second_page['birds']],
+                         [6, 7, 8, 9, 10])
+
+    def test_cursor_paginated_birds_last_page(self):
+        res = self.client().get(
+            '/birds?after=10&limit=5', environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['next_cursor'], None)
+
+    def test_400_cursor_paginated_birds_invalid_cursor(self):
+        res = self.client().get(
+            '/birds?after=abc', environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_paginated_birds_limit_is_capped(self):
+        with patch('app.MAX_ITEMS_PER_PAGE', 3):
+            res = self.client().get(
+                '/birds?limit=1000000', environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['birds']), 3)
+
+    def count_queries(self, url, headers=None, status_code=200):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            # BEGIN is emitted explicitly on sqlite and the rollback mode
+            # wraps commits in savepoints, neither is a query
+            if statement != 'BEGIN' and 'SAVEPOINT' not in statement:
+                statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client().get(url, headers=headers,
+                                    environ_base=headers_viewers)
+        finally:
+            event.remove(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(res.status_code, status_code)
+        return len(statements)
+
+    def test_paginated_birds_query_count(self):
+        # table versions, bird cards and the count
+        small_page = self.count_queries('/birds?limit=2')
+        large_page = self.count_queries('/birds?limit=12')
+        self.assertLessEqual(small_page, 3)
+        self.assertEqual(large_page, small_page)
+
+    def test_specific_bird_query_count(self):
+        # table versions and the bird card
+        self.assertLessEqual(self.count_queries('/birds/1'), 2)
+
     def test_404_beyond_paginated_birds(self):
         res = self.client().get('/birds?page=1000', environ_base=headers_viewers)
         data = json.loads(res.data)
@@ -225,6 +361,49 @@ class BirdsOfTWorldsTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Bird common_name already exist')
 
+    def test_patch_bird_returns_updated_bird(self):
+        res = self.client().patch('/birds/1', json={
+            'habitats': [1, 2], 'species': 'Aptenodytes forsteri'},
+            headers=headers_owner)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated']['species'], 'Aptenodytes forsteri')
+        self.assertEqual([habitat['id'] for habitat in
+                          data['updated']['habitats']], [1, 2])
+
+    def test_422_patch_bird_leaves_no_partial_update(self):
+        with self.app.app_context():
+            species = db.session.get(Bird, 1).species
+        res = self.client().patch('/birds/1', json={
+            'habitats': [1], 'species': 'Aptenodytes forsteri',
+            'common_name': 'Budgerigar'}, headers=headers_owner)
+        self.assertEqual(res.status_code, 422)
+        with self.app.app_context():
+            bird = db.session.get(Bird, 1)
+            self.assertEqual(bird.species, species)
+            self.assertNotEqual([habitat.id for habitat in bird.habitats], [1])
+
+    def test_patch_bird_commits_once(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client().patch('/birds/1', json={
+                'habitats': [1], 'species': 'Aptenodytes forsteri',
+                'image_link': 'https://example.com/bird.jpg'},
+                headers=headers_owner)
+        finally:
+            event.remove(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len([statement for statement in statements
+                              if statement.startswith('UPDATE "Birds"')]), 1)
+
     def test_delete_bird(self):
         delete_id = 1
         res = self.client().delete(
@@ -258,6 +437,22 @@ class BirdsOfTWorldsTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertGreater(data['total_habitats'], 1)
 
+    def test_paginated_habitats_without_total(self):
+        res = self.client().get('/habitats?page=1&total=false',
+                                environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('total_habitats', data)
+
+    def test_cursor_paginated_habitats(self):
+        res = self.client().get('/habitats?after=3&limit=2',
+                                environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([habitat['id'] for habitat in data['habitats']],
+                         [4, 5])
+        self.assertEqual(data['next_cursor'], 5)
+
     def test_404_beyond_paginated_habitats(self):
         res = self.client().get('/habitats?page=1000',
                                 environ_base=headers_viewers)
@@ -299,6 +494,17 @@ class BirdsOfTWorldsTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['habitats'])
 
+    def test_post_search_habitat_skips_habitats_missing_from_cache(self):
+        def search_with_unknown_habitat(search, kinds):
+            return [{'id': 1}, {'id': 99999}], 2
+
+        with patch('app.search_names', search_with_unknown_habitat):
+            res = self.client().post('/habitats', json={'search': 'a'},
+                                     headers=headers_owner)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([habitat['id'] for habitat in
+                          json.loads(res.data)['habitats']], [1])
+
     def test_400_post_habitat_invalid_region(self):
         res = self.client().post(
             '/habitats',  json=self.post_habitat_400_invalid_region, headers=headers_owner)
@@ -376,6 +582,1404 @@ class BirdsOfTWorldsTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 401)
         self.assertEqual(data['success'], False)
 
+    # ----------------------------------------------------------------------------#
+    # Bulk Import Tests
+    # ----------------------------------------------------------------------------#
+
+    def test_bulk_add_birds_ndjson(self):
+        rows = [
+            {'common_name': 'Kea', 'species': 'Nestor notabilis',
+             'habitats': ['Australia']},
+            {'common_name': 'Kakapo', 'species': 'Strigops habroptilus',
+             'habitats': [4, 'eastern australia']},
+            {'common_name': 'Budgerigar', 'species': 'Melopsittacus',
+             'habitats': ['Australia']},
+            {'common_name': 'Moa', 'species': 'Dinornis',
+             'habitats': ['New Zealand']},
+        ]
+        res = self.client().post(
+            '/birds/bulk', headers={**headers_owner,
+                                    'Content-Type': 'application/x-ndjson'},
+            data='\n'.join(json.dumps(row) for row in rows))
+        data = json.loads(res.data)
+        with self.app.app_context():
+            kakapo = Bird.query.filter(
+                Bird.common_name == 'Kakapo').one_or_none()
+            kakapo_habitats = [habitat.id for habitat in kakapo.habitats]
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual([error['row'] for error in data['errors']], [3, 4])
+        self.assertEqual(kakapo_habitats, [4, 7])
+
+    def test_bulk_add_birds_csv_in_batches(self):
+        csv_body = '\n'.join(
+            ['common_name,species,habitats,image_link'] +
+            [f'Bird {number},Species {number},Europe;Asia,'
+             for number in range(5)])
+        res = self.client().post(
+            '/birds/bulk?batch_size=2',
+            headers={**headers_owner, 'Content-Type': 'text/csv'},
+            data=csv_body)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 5)
+        self.assertEqual(data['errors'], [])
+
+    def test_bulk_add_habitats(self):
+        res = self.client().post('/habitats/bulk', headers=headers_owner,
+                                 json=[{'name': 'Alps', 'region': 'Europe'},
+                                       {'name': 'Sahara', 'region': 1},
+                                       {'name': 'Atlantis', 'region': 'Sea'}])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['errors'][0]['row'], 3)
+
+    def test_bulk_names_of_digits_are_names(self):
+        self.client().post('/habitats/bulk', headers=headers_owner,
+                           json=[{'name': '1984', 'region_id': '4'}])
+        csv_body = ('common_name,species,habitats,habitat_ids\n'
+                    'Digit bird,Digit species,1984,1;2\n')
+        res = self.client().post(
+            '/birds/bulk', headers={**headers_owner, 'Content-Type': 'text/csv'},
+            data=csv_body)
+        self.assertEqual(json.loads(res.data)['inserted'], 1)
+        with self.app.app_context():
+            bird = Bird.query.filter(
+                Bird.common_name == 'Digit bird').one()
+            habitat = Habitat.query.filter(Habitat.name == '1984').one()
+            self.assertEqual(habitat.region_id, 4)
+            self.assertEqual(sorted(habitat.id for habitat in bird.habitats),
+                             [1, 2, habitat.id])
+
+    def test_400_bulk_add_birds_malformed_json_list(self):
+        res = self.client().post(
+            '/birds/bulk', data='[{"common_name": "Broken"',
+            content_type='application/json', headers=headers_owner)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.data)['success'], False)
+
+    def test_403_bulk_add_birds_viewer(self):
+        res = self.client().post(
+            '/birds/bulk', json=[self.post_bird_success],
+            headers={'Authorization': f'Bearer {viewer_access_token}'})
+        self.assertEqual(res.status_code, 403)
+
+    def test_bulk_import_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv',
+                                         delete=False) as file:
+            file.write('name,region\nAndes,South America\n')
+        result = self.app.test_cli_runner().invoke(
+            args=['bulk-import', 'habitats', file.name])
+        os.remove(file.name)
+        self.assertIn('inserted 1 of 1 habitats', result.output)
+
+    # ----------------------------------------------------------------------------#
+    # Export Tests
+    # ----------------------------------------------------------------------------#
+
+    def test_export_birds_ndjson(self):
+        res = self.client().get('/export/birds',
+                                environ_base=headers_viewers)
+        birds = [json.loads(line) for line in res.data.decode().splitlines()]
+        bird = json.loads(self.client().get(
+            '/birds/1', environ_base=headers_viewers).data)['bird']
+        with self.app.app_context():
+            total_birds = Bird.query.count()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(birds), total_birds)
+        self.assertEqual(birds[0], bird)
+
+    def test_export_birds_csv(self):
+        res = self.client().get('/export/birds?format=csv',
+                                environ_base=headers_viewers)
+        lines = res.data.decode().splitlines()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[0],
+                         'id,common_name,species,image_link,habitats,regions')
+        self.assertIn('Europe;Northern Africa,Europe;Africa', lines[4])
+
+    def test_export_birds_streams_in_one_query(self):
+        self.assertEqual(self.count_queries('/export/birds'), 1)
+
+    def test_export_habitats(self):
+        res = self.client().get('/export/habitats?format=csv',
+                                environ_base=headers_viewers)
+        lines = res.data.decode().splitlines()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[1], '1,Africa,1,Africa')
+
+    def test_400_export_unknown_format(self):
+        res = self.client().get('/export/birds?format=xml',
+                                environ_base=headers_viewers)
+        self.assertEqual(res.status_code, 400)
+
+    # ----------------------------------------------------------------------------#
+    # Search Endpoint Tests
+    # ----------------------------------------------------------------------------#
+
+    def test_search_birds_and_habitats(self):
+        res = self.client().get('/search?q=eagle',
+                                environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual({item['name'] for item in data['results']},
+                         {'Bald eagle', 'African fish eagle'})
+
+    def test_search_ranks_exact_match_first(self):
+        res = self.client().get('/search?q=africa&type=habitats',
+                                environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(data['results'][0]['name'], 'Africa')
+        self.assertEqual(data['results'][0]['score'], 1.0)
+        self.assertTrue(all(item['type'] == 'habitat'
+                            for item in data['results']))
+
+    def test_search_tolerates_typos(self):
+        res = self.client().get('/search?q=flamingoo&type=birds',
+                                environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(data['results'][0]['name'], 'American flamingo')
+
+    def test_search_paginated(self):
+        res = self.client().get('/search?q=a&limit=2&page=2',
+                                environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['results']), 2)
+        self.assertGreater(data['total_results'], 4)
+
+    def test_search_sees_new_birds(self):
+        self.client().get('/search?q=robin', environ_base=headers_viewers)
+        self.client().post('/birds', json=self.post_bird_success,
+                           headers=headers_owner)
+        res = self.client().get('/search?q=robin',
+                                environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(data['total_results'], 2)
+
+    def test_400_search_without_term(self):
+        res = self.client().get('/search?q=', environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # ----------------------------------------------------------------------------#
+    # Auth Cache Tests
+    # ----------------------------------------------------------------------------#
+
+    def test_jwks_cache_fetches_once(self):
+        calls = []
+
+        def counting_get_jwks():
+            calls.append(1)
+            return mock_get_jwks()
+
+        cache = JWKSCache(fetch=counting_get_jwks)
+        for _ in range(5):
+            self.assertTrue(cache.get_key(JWT_HEADERS['kid']))
+        self.assertEqual(len(calls), 1)
+
+    def test_jwks_cache_refreshes_on_unknown_kid(self):
+        calls = []
+
+        def counting_get_jwks():
+            calls.append(1)
+            return mock_get_jwks()
+
+        cache = JWKSCache(fetch=counting_get_jwks, min_refresh_interval=0)
+        cache.get_key(JWT_HEADERS['kid'])
+        self.assertEqual(cache.get_key('rotated-kid'), None)
+        self.assertEqual(len(calls), 2)
+
+    def test_jwks_cache_throttles_unknown_kid_refresh(self):
+        calls = []
+
+        def counting_get_jwks():
+            calls.append(1)
+            return mock_get_jwks()
+
+        cache = JWKSCache(fetch=counting_get_jwks, min_refresh_interval=60)
+        cache.get_key(JWT_HEADERS['kid'])
+        for _ in range(5):
+            self.assertEqual(cache.get_key('random-kid'), None)
+        self.assertEqual(len(calls), 1)
+
+    def test_jwks_cache_serves_stale_keys_when_refresh_fails(self):
+        responses = [mock_get_jwks]
+
+        def failing_get_jwks():
+            if responses:
+                return responses.pop()()
+            raise OSError('auth0 unavailable')
+
+        cache = JWKSCache(fetch=failing_get_jwks, ttl=0,
+                          min_refresh_interval=0)
+        self.assertTrue(cache.get_key(JWT_HEADERS['kid']))
+        self.assertTrue(cache.get_key(JWT_HEADERS['kid']))
+
+    def test_token_cache_skips_repeated_verification(self):
+        token_cache.clear()
+        for _ in range(3):
+            res = self.client().get(
+                '/regions', environ_base=headers_viewers)
+            self.assertEqual(res.status_code, 200)
+        self.assertEqual(token_cache.stats()['misses'], 1)
+        self.assertEqual(token_cache.stats()['hits'], 2)
+
+    def test_token_cache_expires_at_exp_claim(self):
+        cache = TokenCache()
+        cache.set('expired', {**viewer_token_payload, 'exp': time() - 1})
+        cache.set('valid', viewer_token_payload)
+        self.assertEqual(cache.get('expired'), None)
+        self.assertEqual(cache.get('valid')['sub'], 'auth0|TestID')
+
+    def test_token_cache_evicts_least_recently_used(self):
+        cache = TokenCache(maxsize=2)
+        cache.set('first', viewer_token_payload)
+        cache.set('second', viewer_token_payload)
+        cache.get('first')
+        cache.set('third', viewer_token_payload)
+        self.assertEqual(cache.get('second'), None)
+        self.assertTrue(cache.get('first'))
+        self.assertEqual(cache.stats()['size'], 2)
+
+    # ----------------------------------------------------------------------------#
+    # Response Cache Tests
+    # ----------------------------------------------------------------------------#
+
+    def test_cached_regions_only_check_the_table_version(self):
+        self.assertGreater(self.count_queries('/regions'), 1)
+        self.assertEqual(self.count_queries('/regions'), 1)
+
+    def test_cached_response_still_checks_permissions(self):
+        self.client().get('/regions', environ_base=headers_viewers)
+        res = self.client().get('/regions')
+        self.assertEqual(res.status_code, 401)
+
+    def test_post_bird_invalidates_cached_birds(self):
+        res = self.client().get('/birds', environ_base=headers_viewers)
+        total_birds = json.loads(res.data)['total_birds']
+        self.client().post('/birds', json=self.post_bird_success,
+                           headers=headers_owner)
+        res = self.client().get('/birds', environ_base=headers_viewers)
+        self.assertEqual(json.loads(res.data)['total_birds'], total_birds + 1)
+
+    def test_patch_habitat_invalidates_cached_bird(self):
+        self.client().get('/birds/2', environ_base=headers_viewers)
+        self.client().patch('/habitats/4', json={'name': 'Australasia'},
+                            headers=headers_owner)
+        res = self.client().get('/birds/2', environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(data['bird']['habitats'][0]['name'], 'Australasia')
+
+    def test_lru_response_cache_invalidates_every_variant(self):
+        cache = LRUResponseCache(maxsize=10)
+        cache.set('/birds', 'page=1', b'1')
+        cache.set('/birds', 'page=2', b'2')
+        cache.set('/birds/1', '', b'bird')
+        cache.invalidate('/birds')
+        self.assertEqual(cache.get('/birds', 'page=1'), None)
+        self.assertEqual(cache.get('/birds', 'page=2'), None)
+        self.assertEqual(cache.get('/birds/1', ''), b'bird')
+
+    def test_redis_response_cache(self):
+        class DictRedis:
+            '''local stand-in for the redis hash commands'''
+
+            def __init__(self):
+                self.hashes = {}
+
+            def hget(self, key, field):
+                return self.hashes.get(key, {}).get(field)
+
+            def hset(self, key, field, value):
+                self.hashes.setdefault(key, {})[field] = value
+
+            def expire(self, key, seconds):
+                pass
+
+            def delete(self, *keys):
+                for key in keys:
+                    self.hashes.pop(key, None)
+
+            def scan_iter(self, pattern):
+                return [key for key in list(self.hashes)
+                        if key.startswith(pattern.rstrip('*'))]
+
+        client = DictRedis()
+        cache = RedisResponseCache(client)
+        cache.set('/habitats', 'page=1', b'1')
+        self.assertEqual(cache.get('/habitats', 'page=1'), b'1')
+        cache.invalidate('/habitats')
+        self.assertEqual(cache.get('/habitats', 'page=1'), None)
+
+        # each version has its own hash, the old one is left to expire
+        cache.set('/regions', '', b'1', 'Regions:1')
+        cache.set('/regions', '', b'2', 'Regions:2')
+        self.assertEqual(cache.get('/regions', '', 'Regions:1'), b'1')
+        self.assertEqual(cache.get('/regions', '', 'Regions:2'), b'2')
+        self.assertEqual(client.hashes['botw:response:/regions@Regions:1'],
+                         {'': b'1'})
+
+    # ----------------------------------------------------------------------------#
+    # Conditional Request Tests
+    # ----------------------------------------------------------------------------#
+
+    def test_birds_etag_not_modified(self):
+        res = self.client().get('/birds', environ_base=headers_viewers)
+        etag = res.headers['ETag']
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNotNone(res.headers.get('Last-Modified'))
+        # only the table versions are read for a 304
+        self.assertEqual(self.count_queries(
+            '/birds', headers={'If-None-Match': etag}, status_code=304), 1)
+
+    def test_birds_etag_changes_after_write(self):
+        res = self.client().get('/birds', environ_base=headers_viewers)
+        etag = res.headers['ETag']
+        self.client().post('/birds', json=self.post_bird_success,
+                           headers=headers_owner)
+        res = self.client().get('/birds', headers={'If-None-Match': etag},
+                                environ_base=headers_viewers)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_habitats_etag_changes_with_bird_writes(self):
+        # the habitats show their bird counts
+        res = self.client().get('/habitats', environ_base=headers_viewers)
+        etag = res.headers['ETag']
+        self.client().post('/birds', json=self.post_bird_success,
+                           headers=headers_owner)
+        res = self.client().get('/habitats', headers={'If-None-Match': etag},
+                                environ_base=headers_viewers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_etag_depends_on_query_args(self):
+        first = self.client().get('/birds?page=1', environ_base=headers_viewers)
+        second = self.client().get('/birds?page=2',
+                                   environ_base=headers_viewers)
+        self.assertNotEqual(first.headers['ETag'], second.headers['ETag'])
+
+    def test_regions_if_modified_since(self):
+        res = self.client().get('/regions', environ_base=headers_viewers)
+        res = self.client().get(
+            '/regions',
+            headers={'If-Modified-Since': res.headers['Last-Modified']},
+            environ_base=headers_viewers)
+        self.assertEqual(res.status_code, 304)
+
+    # ----------------------------------------------------------------------------#
+    # Batch Endpoint Tests
+    # ----------------------------------------------------------------------------#
+
+    def test_batch_runs_every_operation(self):
+        res = self.client().post('/batch', json={'operations': [
+            {'op': 'create', 'resource': 'birds',
+             'data': self.post_bird_success},
+            {'op': 'patch', 'resource': 'habitats', 'id': 1,
+             'data': self.patch_habitat_success},
+            {'op': 'delete', 'resource': 'birds', 'id': 2}]},
+            headers=headers_owner)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(all(result['success'] for result in data['results']))
+        with self.app.app_context():
+            self.assertIsNotNone(Bird.query.filter(
+                Bird.id == data['results'][0]['id']).one_or_none())
+            self.assertEqual(db.session.get(Habitat, 1).region_id, 7)
+            self.assertIsNone(db.session.get(Bird, 2))
+
+    def test_batch_reports_failed_operations(self):
+        res = self.client().post('/batch', json={'atomic': False, 'operations': [
+            {'op': 'patch', 'resource': 'birds', 'id': 1,
+             'data': self.patch_bird_422_duplicate},
+            {'op': 'delete', 'resource': 'habitats', 'id': 1000},
+            {'op': 'patch', 'resource': 'birds', 'id': 1,
+             'data': self.patch_bird_success}]},
+            headers=headers_owner)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['success'] for result in data['results']],
+                         [False, False, True])
+        self.assertEqual(data['results'][0]['error'], 422)
+        self.assertEqual(data['results'][1]['error'], 404)
+        self.assertEqual(data['results'][1]['message'], 'resource not found')
+        with self.app.app_context():
+            self.assertEqual(
+                [habitat.id for habitat in db.session.get(Bird, 1).habitats],
+                [1])
+
+    def test_422_atomic_batch_rolls_back(self):
+        res = self.client().post('/batch', json={'operations': [
+            {'op': 'delete', 'resource': 'birds', 'id': 1},
+            {'op': 'delete', 'resource': 'birds', 'id': 1000}]},
+            headers=headers_owner)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['results'][0]['success'], True)
+        with self.app.app_context():
+            self.assertIsNotNone(db.session.get(Bird, 1))
+
+    def test_403_RBAC_batch(self):
+        res = self.client().post('/batch', json={'operations': [
+            {'op': 'delete', 'resource': 'birds', 'id': 1}]},
+            environ_base=headers_viewers)
+        self.assertEqual(res.status_code, 403)
+        with self.app.app_context():
+            self.assertIsNotNone(db.session.get(Bird, 1))
+
+    def test_400_malformed_batch(self):
+        res = self.client().post('/batch', json={'operations': [
+            {'op': 'rename', 'resource': 'birds', 'id': 1}]},
+            headers=headers_owner)
+        self.assertEqual(res.status_code, 400)
+        res = self.client().post('/batch', json={'operations': []},
+                                 headers=headers_owner)
+        self.assertEqual(res.status_code, 400)
+
+    # ----------------------------------------------------------------------------#
+    # Metrics Tests
+    # ----------------------------------------------------------------------------#
+
+    def test_pool_options_from_environment(self):
+        self.assertEqual(pool_options({
+            'DB_POOL_SIZE': '8',
+            'DB_MAX_OVERFLOW': '2',
+            'DB_POOL_RECYCLE': '',
+            'DB_POOL_PRE_PING': 'true'}),
+            {'pool_size': 8, 'max_overflow': 2, 'pool_pre_ping': True})
+
+    def test_metrics_report_pool_checkouts(self):
+        with patch('app.METRICS_ENABLED', True):
+            app = create_app(database_path)
+        client = app.test_client()
+        client.get('/regions', environ_base=headers_viewers)
+        res = client.get('/metrics', headers=headers_owner)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertGreaterEqual(data['database_pool']['checkouts'], 1)
+        self.assertEqual(data['database_pool']['checkedout'], 0)
+        self.assertIn('wait_max_ms', data['database_pool'])
+        self.assertIn('hits', data['token_cache'])
+
+    def test_401_403_metrics_need_permission(self):
+        with patch('app.METRICS_ENABLED', True):
+            app = create_app(database_path)
+        client = app.test_client()
+        self.assertEqual(client.get('/metrics').status_code, 401)
+        res = client.get('/metrics', environ_base=headers_viewers)
+        self.assertEqual(res.status_code, 403)
+
+    def test_pool_waits_timed_after_dispose(self):
+        with patch('app.METRICS_ENABLED', True):
+            app = create_app(database_path)
+        metrics = app.extensions['pool_metrics']
+        with app.app_context():
+            db.engine.dispose()
+            with db.engine.connect():
+                pass
+            self.assertEqual(type(db.engine.pool).__name__, 'TimedQueuePool')
+        self.assertEqual(metrics.waits, 1)
+        self.assertLess(metrics.wait_max, 1)
+
+    def test_404_metrics_disabled(self):
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 404)
+
+    # ----------------------------------------------------------------------------#
+    # Read Replica Tests
+    # ----------------------------------------------------------------------------#
+
+    def replica_app(self):
+        '''an app with a copy of the test database as its replica'''
+        replica_fd, replica_file = tempfile.mkstemp(suffix='.db')
+        os.close(replica_fd)
+        self.addCleanup(os.remove, replica_file)
+        with patch('models.REPLICA_PATHS', [f'sqlite:///{replica_file}']):
+            app = create_app(database_path)
+        shutil.copyfile(make_url(database_path).database, replica_file)
+        return self.rolled_back(app)
+
+    def test_reads_go_to_the_replica(self):
+        if not database_path.startswith('sqlite'):
+            self.skipTest('the replica is a copy of the sqlite test database')
+        app = self.replica_app()
+        client = app.test_client()
+        # a write the replica has not caught up with yet
+        res = client.patch('/habitats/1', json={'name': 'Primary only'},
+                           headers=headers_owner)
+        self.assertEqual(res.status_code, 200)
+
+        other_token = create_test_token(
+            {**viewer_token_payload, 'sub': 'auth0|OtherID'},
+            algorithm=ALGORITHMS)
+        res = client.get('/habitats/1', headers={
+            'Authorization': f'Bearer {other_token}'})
+        self.assertNotEqual(json.loads(res.data)['habitat']['name'],
+                            'Primary only')
+
+    def test_writer_reads_own_writes_from_primary(self):
+        if not database_path.startswith('sqlite'):
+            self.skipTest('the replica is a copy of the sqlite test database')
+        app = self.replica_app()
+        client = app.test_client()
+        client.patch('/habitats/1', json={'name': 'Primary only'},
+                     headers=headers_owner)
+        res = client.get('/habitats/1', headers=headers_owner)
+        self.assertEqual(json.loads(res.data)['habitat']['name'],
+                         'Primary only')
+
+        app.extensions['replica_router'].sticky_seconds = 0
+        res = client.get('/habitats/1', headers=headers_owner)
+        self.assertNotEqual(json.loads(res.data)['habitat']['name'],
+                            'Primary only')
+
+    def test_last_write_header_reads_from_primary(self):
+        if not database_path.startswith('sqlite'):
+            self.skipTest('the replica is a copy of the sqlite test database')
+        app = self.replica_app()
+        client = app.test_client()
+        res = client.patch('/habitats/1', json={'name': 'Primary only'},
+                           headers=headers_owner)
+        last_write = res.headers['X-Last-Write']
+        # another worker, which did not see the write
+        app.extensions['replica_router'].write_log = MemoryWriteLog()
+        res = client.get('/habitats/1', headers={
+            **headers_owner, 'X-Last-Write': last_write})
+        self.assertEqual(json.loads(res.data)['habitat']['name'],
+                         'Primary only')
+        res = client.get('/habitats/1', headers=headers_owner)
+        self.assertNotEqual(json.loads(res.data)['habitat']['name'],
+                            'Primary only')
+
+    def test_redis_write_log_is_shared_by_workers(self):
+        class KeyRedis:
+            '''local stand-in for the redis key commands'''
+
+            def __init__(self):
+                self.keys = {}
+
+            def set(self, key, value, px):
+                self.keys[key] = time() + px / 1000
+
+            def exists(self, key):
+                return int(self.keys.get(key, 0) > time())
+
+        write_log = RedisWriteLog(KeyRedis())
+        worker = ReplicaRouter(['replica_0'], write_log=write_log)
+        other_worker = ReplicaRouter(['replica_0'], write_log=write_log)
+        worker.record_write('auth0|TestID')
+        self.assertTrue(other_worker.sticky('auth0|TestID'))
+        self.assertFalse(other_worker.sticky('auth0|OtherID'))
+        self.assertTrue(other_worker.sticky('auth0|OtherID', time()))
+        self.assertFalse(other_worker.sticky('auth0|OtherID', time() - 60))
+
+    def test_replica_router_round_robin(self):
+        router = ReplicaRouter(['replica_0', 'replica_1'])
+        self.assertEqual([router.choose() for _ in range(4)],
+                         ['replica_0', 'replica_1', 'replica_0', 'replica_1'])
+
+    def test_replica_router_least_load(self):
+        router = ReplicaRouter(['replica_0', 'replica_1'],
+                               strategy='least_load')
+        busy = router.choose()
+        self.assertNotEqual(router.choose(), busy)
+        router.release(busy)
+        self.assertEqual(router.choose(), busy)
+
+    # ----------------------------------------------------------------------------#
+    # ASGI Tests
+    # ----------------------------------------------------------------------------#
+
+    def asgi_get(self, application, path, headers={}):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(application({
+            'type': 'http', 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': path, 'root_path': '',
+            'query_string': b'', 'server': ('testserver', 80),
+            'client': ('127.0.0.1', 50000),
+            'headers': [(name.lower().encode(), value.encode())
+                        for name, value in headers.items()]},
+            receive, send))
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return messages[0]['status'], json.loads(body)
+
+    def test_asgi_serves_the_same_responses(self):
+        status, data = self.asgi_get(ASGIApplication(self.app), '/regions',
+                                     headers_owner)
+        res = self.client().get('/regions', headers=headers_owner)
+        self.assertEqual(status, 200)
+        self.assertEqual(data, json.loads(res.data))
+
+    def test_401_asgi_error_shape(self):
+        status, data = self.asgi_get(ASGIApplication(self.app), '/birds')
+        self.assertEqual(status, 401)
+        self.assertEqual(data['success'], False)
+
+    def test_asgi_runs_requests_concurrently(self):
+        slow_app = Flask('slow')
+
+        @slow_app.route('/slow')
+        def slow():
+            sleep(0.2)
+            return 'done'
+        async def request(application):
+            sent = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                sent.append(message)
+            await application({
+                'type': 'http', 'http_version': '1.1', 'method': 'GET',
+                'path': '/slow', 'query_string': b'', 'headers': []},
+                receive, send)
+            return sent[0]['status']
+
+        async def requests(threads):
+            application = ASGIApplication(slow_app, threads=threads)
+            return await asyncio.gather(
+                *(request(application) for _ in range(4)))
+
+        start = time()
+        self.assertEqual(asyncio.run(requests(4)), [200] * 4)
+        self.assertLess(time() - start, 0.6)
+        # no more than ASGI_THREADS requests at once
+        start = time()
+        self.assertEqual(asyncio.run(requests(2)), [200] * 4)
+        self.assertGreaterEqual(time() - start, 0.4)
+
+    def test_asgi_lifespan_fetches_the_jwks(self):
+        fetches = []
+
+        def fetch():
+            fetches.append(1)
+            return mock_get_jwks()
+        jwks = JWKSCache(fetch=fetch)
+        application = ASGIApplication(self.app, threads=2, jwks=jwks)
+
+        async def lifespan():
+            messages = asyncio.Queue()
+            sent = []
+            for message in ['lifespan.startup', 'lifespan.shutdown']:
+                messages.put_nowait({'type': message})
+
+            async def send(message):
+                sent.append(message['type'])
+            await application({'type': 'lifespan'}, messages.get, send)
+            return sent
+
+        self.assertEqual(asyncio.run(lifespan()), [
+            'lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertEqual(len(fetches), 1)
+        self.assertIsNotNone(jwks.get_key(JWT_HEADERS['kid']))
+        self.assertEqual(len(fetches), 1)
+
+    # ----------------------------------------------------------------------------#
+    # Bird Card Tests
+    # ----------------------------------------------------------------------------#
+
+    def bird_card(self, bird_id):
+        with self.app.app_context():
+            card = db.session.get(BirdCard, bird_id)
+            return card and card.card
+
+    def test_bird_cards_match_bird_format(self):
+        with self.app.app_context():
+            birds = Bird.query.all()
+            formatted = {bird.id: bird.format() for bird in birds}
+            cards = {card.bird_id: card.card for card in BirdCard.query}
+        self.assertEqual(cards.keys(), formatted.keys())
+        for bird_id, card in cards.items():
+            bird = formatted[bird_id]
+            self.assertEqual(sorted(card['habitats'], key=str),
+                             sorted(bird['habitats'], key=str))
+            self.assertEqual(sorted(card['regions'], key=str),
+                             sorted(bird['regions'], key=str))
+            self.assertEqual(card['common_name'], bird['common_name'])
+
+    def test_bird_card_follows_writes(self):
+        res = self.client().post('/birds', json=self.post_bird_success,
+                                 headers=headers_owner)
+        bird_id = json.loads(res.data)['bird']
+        self.assertEqual([habitat['id'] for habitat in
+                          self.bird_card(bird_id)['habitats']], [1, 2])
+
+        self.client().patch('/habitats/1', json={'name': 'Renamed'},
+                            headers=headers_owner)
+        self.assertEqual(self.bird_card(bird_id)['habitats'][0]['name'],
+                         'Renamed')
+
+        self.client().delete('/habitats/1', headers=headers_owner)
+        self.assertEqual([habitat['id'] for habitat in
+                          self.bird_card(bird_id)['habitats']], [2])
+
+        self.client().delete(f'/birds/{bird_id}', headers=headers_owner)
+        self.assertIsNone(self.bird_card(bird_id))
+
+    def test_rebuild_bird_cards_command(self):
+        with self.app.app_context():
+            db.session.query(BirdCard).delete()
+            db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['rebuild-bird-cards'])
+        self.assertIn('rebuilt', result.output)
+        self.assertIsNotNone(self.bird_card(1))
+
+    def test_init_db_command_backfills_bird_cards(self):
+        with self.app.app_context():
+            db.session.query(BirdCard).delete()
+            db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['init-db'])
+        self.assertIn('database initialized', result.output)
+        self.assertIsNotNone(self.bird_card(1))
+
+    def test_bird_card_and_version_writes_upsert(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            # a card another transaction wrote first is updated, not a
+            # primary key violation
+            db.session.get(BirdCard, 1).card = {'stale': True}
+            db.session.commit()
+            connection = db.session.connection()
+            event.listen(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            try:
+                refresh_bird_cards(connection, [1])
+                bump_version('Upserted')
+                bump_version('Upserted')
+            finally:
+                event.remove(db.engine, 'before_cursor_execute',
+                             before_cursor_execute)
+            self.assertEqual(get_versions('Upserted')['Upserted'][0], 2)
+            db.session.commit()
+        self.assertEqual(self.bird_card(1)['id'], 1)
+        self.assertFalse([statement for statement in statements
+                          if statement.startswith('DELETE')
+                          and 'NOT IN' not in statement])
+        self.assertEqual(len([statement for statement in statements
+                              if 'ON CONFLICT' in statement]), 3)
+
+    # ----------------------------------------------------------------------------#
+    # Counter Tests
+    # ----------------------------------------------------------------------------#
+
+    def assertCountsMatch(self):
+        '''the counters are the counts of the relationships'''
+        with self.app.app_context():
+            db.session.expire_all()
+            for habitat in Habitat.query:
+                self.assertEqual(habitat.bird_count, len(habitat.Birds))
+            for region in Region.query:
+                birds = {bird.id for habitat in region.habitats
+                         for bird in habitat.Birds}
+                self.assertEqual(
+                    (region.habitat_count, region.bird_count),
+                    (len(region.habitats), len(birds)))
+
+    def test_seeded_counts(self):
+        self.assertCountsMatch()
+        with self.app.app_context():
+            self.assertGreater(db.session.get(Habitat, 8).bird_count, 0)
+
+    def test_counts_follow_bird_writes(self):
+        res = self.client().post('/birds', json=self.post_bird_success,
+                                 headers=headers_owner)
+        bird_id = json.loads(res.data)['bird']
+        self.assertCountsMatch()
+        self.client().patch(f'/birds/{bird_id}', json={'habitats': [4, 8]},
+                            headers=headers_owner)
+        self.assertCountsMatch()
+        self.client().delete(f'/birds/{bird_id}', headers=headers_owner)
+        self.assertCountsMatch()
+
+    def test_counts_follow_habitat_writes(self):
+        res = self.client().post('/habitats', json={
+            **self.post_habitat_success, 'bird': 1}, headers=headers_owner)
+        habitat_id = json.loads(res.data)['habitat']
+        self.assertCountsMatch()
+        self.client().patch(f'/habitats/{habitat_id}',
+                            json=self.patch_habitat_success,
+                            headers=headers_owner)
+        self.assertCountsMatch()
+        self.client().delete(f'/habitats/{habitat_id}', headers=headers_owner)
+        self.assertCountsMatch()
+
+    def test_counts_follow_bulk_import(self):
+        res = self.client().post('/birds/bulk', json=[
+            {'common_name': 'Bulk bird', 'species': 'Bulk species',
+             'habitats': [1, 2]}], headers=headers_owner)
+        self.assertEqual(json.loads(res.data)['inserted'], 1)
+        self.assertCountsMatch()
+
+    def test_habitat_region_id_sent_as_a_string(self):
+        res = self.client().patch('/habitats/1', json={'region_id': '7'},
+                                  headers=headers_owner)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['updated']['region_id'], 7)
+        res = self.client().post('/habitats', json={
+            **self.post_habitat_success, 'region_id': '4'},
+            headers=headers_owner)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().patch('/habitats/1', json={'region_id': 'seven'},
+                                  headers=headers_owner)
+        self.assertEqual(res.status_code, 400)
+        self.assertCountsMatch()
+
+    def test_counts_are_added_to(self):
+        # writes of other transactions the recount would not see
+        with self.app.app_context():
+            db.session.get(Habitat, 1).bird_count = 100
+            db.session.get(Region, 4).habitat_count = 50
+            db.session.commit()
+        self.client().post('/birds', json=self.post_bird_success,
+                           headers=headers_owner)
+        self.client().post('/habitats', json=self.post_habitat_success,
+                           headers=headers_owner)
+        with self.app.app_context():
+            self.assertEqual(db.session.get(Habitat, 1).bird_count, 101)
+            self.assertEqual(db.session.get(Region, 4).habitat_count, 51)
+
+    def test_region_birds_recount_locks_the_regions(self):
+        statements = []
+
+        def before_execute(conn, clauseelement, *args):
+            statements.append(clauseelement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_execute', before_execute)
+        try:
+            self.client().post('/birds', json=self.post_bird_success,
+                               headers=headers_owner)
+        finally:
+            event.remove(engine, 'before_execute', before_execute)
+        locks = [str(statement.compile(dialect=postgresql.dialect()))
+                 for statement in statements
+                 if getattr(statement, '_for_update_arg', None) is not None]
+        self.assertEqual(len(locks), 1)
+        self.assertIn('FROM "Regions"', locks[0])
+        self.assertIn('FOR UPDATE', locks[0])
+        self.assertCountsMatch()
+
+    def test_regions_show_counts(self):
+        res = self.client().get('/regions', environ_base=headers_viewers)
+        regions = json.loads(res.data)['regions']
+        with self.app.app_context():
+            expected = {region.id: (region.habitat_count, region.bird_count)
+                        for region in Region.query}
+        self.assertEqual({region['id']: (region['habitat_count'],
+                                         region['bird_count'])
+                          for region in regions}, expected)
+
+    def test_regions_etag_changes_with_bird_writes(self):
+        res = self.client().get('/regions', environ_base=headers_viewers)
+        etag = res.headers['ETag']
+        self.client().post('/birds', json=self.post_bird_success,
+                           headers=headers_owner)
+        res = self.client().get('/regions', headers={'If-None-Match': etag},
+                                environ_base=headers_viewers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_rebuild_counts_command(self):
+        with self.app.app_context():
+            db.session.query(Habitat).update({'bird_count': 1000})
+            db.session.query(Region).update({'bird_count': 1000})
+            db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['rebuild-counts'])
+        self.assertIn('recounted', result.output)
+        self.assertCountsMatch()
+
+    def test_add_missing_columns(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        engine = create_engine(f'sqlite:///{directory}/old.db')
+        self.addCleanup(engine.dispose)
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                'ALTER TABLE "Habitats" DROP COLUMN bird_count')
+        self.assertEqual(add_missing_columns(engine), ['Habitats.bird_count'])
+        self.assertEqual(add_missing_columns(engine), [])
+
+    # ----------------------------------------------------------------------------#
+    # Startup Tests
+    # ----------------------------------------------------------------------------#
+
+    def test_startup_report(self):
+        startup = self.app.extensions['startup_ms']
+        self.assertEqual(list(startup),
+                         ['database', 'extensions', 'routes', 'total'])
+        self.assertAlmostEqual(
+            startup['total'], sum(startup.values()) - startup['total'],
+            delta=0.05)
+        result = self.app.test_cli_runner().invoke(args=['startup-report'])
+        self.assertIn('database', result.output)
+
+    def test_rollback_transaction_discards_commits(self):
+        app = create_app(database_path)
+        with rollback_transaction(app):
+            app.test_client().delete('/birds/1', headers=headers_owner)
+            with app.app_context():
+                self.assertIsNone(db.session.get(Bird, 1))
+        with app.app_context():
+            self.assertIsNotNone(db.session.get(Bird, 1))
+
+    def test_seed_snapshot_restores_committed_writes(self):
+        app = create_app(database_path)
+        app.test_client().delete('/birds/1', headers=headers_owner)
+        app = create_app(database_path)
+        with app.app_context():
+            self.assertIsNotNone(db.session.get(Bird, 1))
+            self.assertIsNotNone(db.session.get(BirdCard, 1))
+            total_birds = Bird.query.count()
+        res = app.test_client().post('/birds', json=self.post_bird_success,
+                                     headers=headers_owner)
+        self.assertEqual(json.loads(res.data)['bird'], total_birds + 1)
+
+    def test_isolated_database_url(self):
+        self.assertEqual(
+            isolated_database_url('sqlite:////tmp/testbotw.db', 'gw1'),
+            'sqlite:////tmp/testbotw-gw1.db')
+        with patch.dict(os.environ, {'PYTEST_XDIST_WORKER': '',
+                                     'TEST_WORKER': ''}):
+            self.assertEqual(
+                isolated_database_url('sqlite:////tmp/testbotw.db'),
+                'sqlite:////tmp/testbotw.db')
+
+    # ----------------------------------------------------------------------------#
+    # JSON Provider Tests
+    # ----------------------------------------------------------------------------#
+
+    def test_orjson_provider_matches_default_bytes(self):
+        payload = {
+            'success': True,
+            'name': 'Gr\u00fcnspecht \U0001F426 \x7f "quoted" / \\',
+            'scores': [0.3333, 1e-05, 1e16, -0.0, 2 ** 70],
+            'created': datetime(2023, 12, 1, 10, 30),
+            'nested': {'b': None, 'a': [{'z': 1, 'y': 2}]}}
+        with self.app.app_context():
+            for obj in [payload, {'plain': ['ascii', 1, 2.5]}]:
+                self.assertEqual(
+                    ORJSONProvider(self.app).response(obj).get_data(),
+                    DefaultJSONProvider(self.app).response(obj).get_data())
+            with patch('json_provider.orjson', None):
+                self.assertEqual(
+                    ORJSONProvider(self.app).response(payload).get_data(),
+                    DefaultJSONProvider(self.app).response(payload).get_data())
+
+    def test_orjson_provider_keeps_float_like_strings_on_orjson(self):
+        obj = {'image_link': 'https://example.com/a1e2', 'id': 'x0.00001',
+               'score': 0.5}
+        provider = ORJSONProvider(self.app)
+        with self.app.app_context():
+            data = provider.dumps_compact(obj)
+            self.assertIsNotNone(data)
+            self.assertEqual(
+                provider.response(obj).get_data(),
+                DefaultJSONProvider(self.app).response(obj).get_data())
+            self.assertIsNone(provider.dumps_compact({'score': [1e-05]}))
+            self.assertIsNone(provider.dumps_compact(float('nan')))
+
+    def test_habitat_rows_match_habitat_format(self):
+        res = self.client().get('/habitats?limit=100',
+                                environ_base=headers_viewers)
+        with self.app.app_context():
+            formatted = [{**habitat.format(), 'bird_count': len(habitat.Birds)}
+                         for habitat in
+                         Habitat.query.order_by(Habitat.id).limit(100)]
+        self.assertEqual(json.loads(res.data)['habitats'], formatted)
+
+    # ----------------------------------------------------------------------------#
+    # Compression Tests
+    # ----------------------------------------------------------------------------#
+
+    def test_gzip_response_matches_plain_json(self):
+        plain = self.client().get('/birds', environ_base=headers_viewers)
+        res = self.client().get('/birds', environ_base=headers_viewers,
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertLess(len(res.data), len(plain.data))
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertEqual(res.headers['ETag'], 'W/' + plain.headers['ETag'])
+
+    def test_no_compression_below_threshold_or_unasked(self):
+        res = self.client().get('/birds', environ_base=headers_viewers)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        with patch('compress.COMPRESS_MIN_SIZE', 10 ** 6):
+            res = self.client().get('/birds', environ_base=headers_viewers,
+                                    headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_not_modified_has_the_headers_of_the_compressed_response(self):
+        for headers in [{'Accept-Encoding': 'gzip'}, {}]:
+            res = self.client().get('/habitats/1', headers=headers,
+                                    environ_base=headers_viewers)
+            not_modified = self.client().get(
+                '/habitats/1', environ_base=headers_viewers,
+                headers={**headers, 'If-None-Match': res.headers['ETag']})
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.headers['ETag'], res.headers['ETag'])
+            self.assertIn('Accept-Encoding', not_modified.headers['Vary'])
+        # the uncompressed small body is weak too when an encoding is accepted
+        self.assertTrue(res.headers['ETag'].startswith('"'))
+        res = self.client().get('/habitats/1', environ_base=headers_viewers,
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertTrue(res.headers['ETag'].startswith('W/'))
+
+    def test_compressed_body_is_cached(self):
+        with patch('compress.compress_body',
+                   wraps=compress.compress_body) as compress_body:
+            for _ in range(2):
+                res = self.client().get(
+                    '/birds', environ_base=headers_viewers,
+                    headers={'Accept-Encoding': 'gzip'})
+                self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(compress_body.call_count, 1)
+        res = self.client().get(
+            '/birds', environ_base=headers_viewers,
+            headers={'Accept-Encoding': 'gzip',
+                     'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_gzip_export_stream(self):
+        plain = self.client().get('/export/birds',
+                                  environ_base=headers_viewers)
+        res = self.client().get('/export/birds', environ_base=headers_viewers,
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+
+    @unittest.skipIf(compress.brotli is None, 'brotli is not installed')
+    def test_brotli_preferred_when_accepted(self):
+        plain = self.client().get('/birds', environ_base=headers_viewers)
+        res = self.client().get('/birds', environ_base=headers_viewers,
+                                headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        self.assertEqual(compress.brotli.decompress(res.data), plain.data)
+
+    # ----------------------------------------------------------------------------#
+    # Profiling Tests
+    # ----------------------------------------------------------------------------#
+
+    def profiling_app(self):
+        with patch('app.PROFILING_ENABLED', True), \
+                patch('app.METRICS_ENABLED', True):
+            return create_app(database_path)
+
+    def test_server_timing_header(self):
+        client = self.profiling_app().test_client()
+        res = client.get('/habitats', environ_base=headers_viewers)
+        metrics = {metric.split(';')[0]: metric for metric in
+                   res.headers['Server-Timing'].split(', ')}
+        self.assertIn('auth', metrics)
+        self.assertIn('jwt', metrics)
+        self.assertIn('paginate', metrics)
+        self.assertIn('serialize', metrics)
+        self.assertIn('total', metrics)
+        self.assertIn('x"', metrics['db'])
+
+    def test_no_server_timing_when_disabled(self):
+        res = self.client().get('/regions', environ_base=headers_viewers)
+        self.assertNotIn('Server-Timing', res.headers)
+
+    def test_metrics_report_route_histograms(self):
+        client = self.profiling_app().test_client()
+        for bird_id in [1, 2]:
+            client.get(f'/birds/{bird_id}', environ_base=headers_viewers)
+        client.get('/birds/1')
+        routes = json.loads(client.get(
+            '/metrics', headers=headers_owner).data)['routes']
+        self.assertEqual(routes['GET /birds/<int:bird_id>']['count'], 3)
+        self.assertEqual(
+            routes['GET /birds/<int:bird_id>']['buckets']['le_inf'], 3)
+        self.assertGreater(
+            routes['GET /birds/<int:bird_id>']['queries_per_request'], 0)
+
+    def test_route_histogram_buckets(self):
+        histograms = RouteHistograms([10, 100])
+        for seconds in [0.001, 0.05, 0.05, 2]:
+            histograms.observe('GET /regions', seconds, 1)
+        stats = histograms.stats()['GET /regions']
+        self.assertEqual(stats['buckets'],
+                         {'le_10': 1, 'le_100': 3, 'le_inf': 4})
+        self.assertEqual(stats['max_ms'], 2000)
+        self.assertEqual(stats['queries_per_request'], 1)
+
+    def test_profile_header_dumps_cprofile(self):
+        client = self.profiling_app().test_client()
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with patch('profiling.PROFILE_DIR', profile_dir), \
+                    patch('profiling.PROFILE_SECRET', 'profile-secret'):
+                res = client.get('/birds', environ_base=headers_viewers,
+                                 headers={'X-Profile': 'profile-secret'})
+            self.assertNotIn('X-Profile-File', res.headers)
+            [path] = glob.glob(os.path.join(profile_dir, '*.prof'))
+            functions = pstats.Stats(path).stats
+        self.assertTrue(any(name == 'get_birds'
+                            for _, _, name in functions))
+
+    def test_profile_header_needs_the_secret(self):
+        client = self.profiling_app().test_client()
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with patch('profiling.PROFILE_DIR', profile_dir):
+                client.get('/birds', environ_base=headers_viewers,
+                           headers={'X-Profile': '1'})
+                with patch('profiling.PROFILE_SECRET', 'profile-secret'):
+                    client.get('/birds', environ_base=headers_viewers,
+                               headers={'X-Profile': '1'})
+            self.assertEqual(os.listdir(profile_dir), [])
+
+    def test_profile_dumps_are_rotated(self):
+        client = self.profiling_app().test_client()
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with patch('profiling.PROFILE_DIR', profile_dir), \
+                    patch('profiling.PROFILE_SECRET', 'profile-secret'), \
+                    patch('profiling.PROFILE_MAX_FILES', 2):
+                for bird_id in range(1, 5):
+                    client.get(f'/birds/{bird_id}',
+                               environ_base=headers_viewers,
+                               headers={'X-Profile': 'profile-secret'})
+            self.assertEqual(len(os.listdir(profile_dir)), 2)
+
+    # ----------------------------------------------------------------------------#
+    # Reference Data Tests
+    # ----------------------------------------------------------------------------#
+
+    def test_habitat_lookup_only_checks_the_table_version(self):
+        self.count_queries('/habitats/1')
+        self.assertEqual(self.count_queries('/habitats/2'), 1)
+        res = self.client().get('/habitats/2', environ_base=headers_viewers)
+        with self.app.app_context():
+            habitat = db.session.get(Habitat, 2).format()
+        self.assertEqual(json.loads(res.data)['habitat'], habitat)
+
+    def test_habitat_representations_show_bird_count(self):
+        with self.app.app_context():
+            habitat = db.session.get(Habitat, 1)
+            name, bird_count = habitat.name, habitat.bird_count
+        res = self.client().get('/habitats/1', environ_base=headers_viewers)
+        self.assertEqual(json.loads(res.data)['habitat']['bird_count'],
+                         bird_count)
+        etag = res.headers['ETag']
+        # a bird write changes the cached habitat row and its response
+        self.client().post('/birds', json=self.post_bird_success,
+                           headers=headers_owner)
+        res = self.client().get('/habitats/1', headers={'If-None-Match': etag},
+                                environ_base=headers_viewers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['habitat']['bird_count'],
+                         bird_count + 1)
+        res = self.client().post('/habitats', json={'search': name},
+                                 headers=headers_owner)
+        [found] = [habitat for habitat in json.loads(res.data)['habitats']
+                   if habitat['id'] == 1]
+        self.assertEqual(found['bird_count'], bird_count + 1)
+        res = self.client().patch('/habitats/1',
+                                  json={'name': f'{name} patched'},
+                                  headers=headers_owner)
+        self.assertEqual(json.loads(res.data)['updated']['bird_count'],
+                         bird_count + 1)
+        res = self.client().post('/habitats', json={
+            **self.post_habitat_success, 'bird': 1}, headers=headers_owner)
+        self.assertEqual(json.loads(res.data)['habitat']['bird_count'], 1)
+
+    def test_post_bird_validates_habitats_from_reference_data(self):
+        self.client().get('/habitats/1', environ_base=headers_viewers)
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            unknown = self.client().post(
+                '/birds', json=dict(self.post_bird_success, habitats=[1, 999]),
+                headers=headers_owner)
+        finally:
+            event.remove(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(unknown.status_code, 404)
+        self.assertFalse([statement for statement in statements
+                          if statement.startswith('SELECT') and
+                          'FROM "Habitats"' in statement])
+
+    def test_post_bird_loads_the_habitats_it_links(self):
+        self.client().get('/habitats/1', environ_base=headers_viewers)
+        # another worker renames the habitat without this app reading it
+        with self.app.app_context():
+            db.session.get(Habitat, 1).name = 'Afrika'
+            db.session.commit()
+            engine = db.engine
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client().post('/birds', json=dict(
+                self.post_bird_success, habitats=list(range(1, 9))),
+                headers=headers_owner)
+        finally:
+            event.remove(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(res.status_code, 200)
+        # the habitats are loaded together
+        self.assertEqual(len([statement for statement in statements
+                              if statement.startswith('SELECT "Habitats"')]),
+                         1)
+        card = self.bird_card(json.loads(res.data)['bird'])
+        self.assertEqual([habitat['id'] for habitat in card['habitats']],
+                         list(range(1, 9)))
+        with self.app.app_context():
+            habitat = db.session.get(Habitat, 1)
+            self.assertEqual(habitat.name, 'Afrika')
+            self.assertEqual(habitat.bird_count, len(habitat.Birds))
+
+    def test_reference_data_follows_other_workers_writes(self):
+        self.client().get('/habitats/1', environ_base=headers_viewers)
+        # another worker renames the habitat, this app only sees the version
+        with self.app.app_context():
+            db.session.get(Habitat, 1).name = 'Afrika'
+            bump_version('Habitats')
+            db.session.commit()
+        res = self.client().get('/habitats/1', environ_base=headers_viewers)
+        self.assertEqual(json.loads(res.data)['habitat']['name'], 'Afrika')
+
+    def test_batch_bird_in_habitat_created_by_the_batch(self):
+        habitat = {'name': 'Patagonia', 'region_id': 7}
+        self.client().get('/habitats/1', environ_base=headers_viewers)
+        with self.app.app_context():
+            habitat_id = db.session.query(db.func.max(Habitat.id)).scalar() + 1
+        res = self.client().post('/batch', json={'operations': [
+            {'op': 'create', 'resource': 'habitats', 'data': habitat},
+            {'op': 'create', 'resource': 'birds',
+             'data': {**self.post_bird_success, 'habitats': [habitat_id]}}]},
+            headers=headers_owner)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['results'][0]['id'], habitat_id)
+
+    def test_400_post_habitat_unknown_region_from_reference_data(self):
+        self.client().get('/regions', environ_base=headers_viewers)
+        res = self.client().post('/habitats',
+                                 json=self.post_habitat_400_invalid_region,
+                                 headers=headers_owner)
+        self.assertEqual(res.status_code, 400)
+
+    # ----------------------------------------------------------------------------#
+    # Graph Tests
+    # ----------------------------------------------------------------------------#
+
+    def test_region_birds(self):
+        res = self.client().get('/regions/1/birds?limit=100',
+                                environ_base=headers_viewers)
+        data = json.loads(res.data)
+        with self.app.app_context():
+            expected = sorted(bird.id for bird in Bird.query if any(
+                habitat.region_id == 1 for habitat in bird.habitats))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([bird['id'] for bird in data['birds']], expected)
+        self.assertEqual(data['total_birds'], len(expected))
+        self.assertEqual(data['birds'][0], self.bird_card(expected[0]))
+
+    def test_region_birds_keyset_pages(self):
+        first = json.loads(self.client().get(
+            '/regions/1/birds?limit=1', environ_base=headers_viewers).data)
+        second = json.loads(self.client().get(
+            f'/regions/1/birds?limit=1&after={first["next_cursor"]}',
+            environ_base=headers_viewers).data)
+        self.assertGreater(second['birds'][0]['id'], first['birds'][0]['id'])
+
+    def test_404_region_birds_unknown_region(self):
+        res = self.client().get('/regions/1000/birds',
+                                environ_base=headers_viewers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_related_birds(self):
+        res = self.client().get('/birds/9/related?min_shared=1&limit=100',
+                                environ_base=headers_viewers)
+        data = json.loads(res.data)
+        with self.app.app_context():
+            habitats = {habitat.id for habitat in
+                        db.session.get(Bird, 9).habitats}
+            shared = {bird.id: len(habitats & {habitat.id for habitat in
+                                               bird.habitats})
+                      for bird in Bird.query if bird.id != 9}
+        expected = sorted(((-count, bird_id) for bird_id, count in
+                           shared.items() if count >= 1))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [(-bird['shared_habitats'], bird['id'])
+             for bird in data['related_birds']], expected)
+        self.assertEqual(data['total_birds'], len(expected))
+
+    def test_related_birds_min_shared(self):
+        res = self.client().get('/birds/9/related?min_shared=2',
+                                environ_base=headers_viewers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(bird['id'], bird['shared_habitats'])
+                          for bird in data['related_birds']], [(11, 3)])
+        res = self.client().get('/birds/9/related?min_shared=0',
+                                environ_base=headers_viewers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_404_related_birds_unknown_bird(self):
+        res = self.client().get('/birds/1000/related',
+                                environ_base=headers_viewers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_habitat_stats(self):
+        res = self.client().get('/habitats/stats?limit=100',
+                                environ_base=headers_viewers)
+        data = json.loads(res.data)
+        with self.app.app_context():
+            expected = sorted((-len(habitat.Birds), habitat.id)
+                              for habitat in Habitat.query)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(-habitat['bird_count'], habitat['id'])
+                          for habitat in data['habitats']], expected)
+        self.assertEqual(set(data['habitats'][0]),
+                         {'id', 'name', 'region_id', 'bird_count'})
+
+    def test_401_habitat_stats_invalid_token(self):
+        res = self.client().get('/habitats/stats',
+                                headers={'Authorization': 'Bearer x'})
+        self.assertEqual(res.status_code, 401)
+
+    def test_graph_queries_use_the_range_indexes(self):
+        with self.app.app_context():
+            if db.engine.dialect.name != 'sqlite':
+                self.skipTest('sqlite query plan')
+            plan = ' '.join(row[-1] for row in db.session.execute(
+                db.text('EXPLAIN QUERY PLAN ' + str(
+                    related_birds_query(1).statement.compile(
+                        compile_kwargs={'literal_binds': True})))))
+        self.assertIn('ix_range_bird_id_habitat_id', plan)
+        self.assertIn('sqlite_autoindex_range_1', plan)
+
 
 # Make the tests conveniently executable
 if __name__ == '__main__':